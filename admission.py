@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import text
+
+from config import (
+    LLM_ADMISSION_CAPACITY, LLM_ADMISSION_QUEUE, LLM_ADMISSION_TIMEOUT, LLM_BATCH_LANE_LIMIT,
+    LLM_BACKGROUND_LANE_LIMIT, LLM_ADMISSION_SYNC_INTERVAL, LLM_CLUSTER_BACKGROUND_LIMIT,
+)
+from metrics import LLM_ADMISSIONS, LLM_ADMISSION_WAIT
+
+logger = logging.getLogger(__name__)
+
+# Highest priority first. Only background requests wait for a slot without limit.
+LANES = ("interactive", "batch", "background")
+
+_current_lane = ContextVar("llm_lane", default="background")
+_admitted = ContextVar("llm_admitted", default=False)
+
+# Lane limits of this process, shared by its controllers. ClusterBudget changes the background one.
+_limits = {
+    "interactive": LLM_ADMISSION_CAPACITY,
+    "batch": LLM_BATCH_LANE_LIMIT,
+    "background": LLM_BACKGROUND_LANE_LIMIT,
+}
+
+
+class OverloadedError(Exception):
+    """Raised when the LLM budget is exhausted and the request can't wait for a slot."""
+
+    def __init__(self, lane, retry_after):
+        super().__init__(f"LLM capacity exhausted for {lane} requests, retry after {retry_after}s")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+@contextmanager
+def lane(name: str, admitted: bool = False):
+    """
+    Run the LLM requests made inside the block (and the tasks it starts) in the given lane,
+    as requests admitted up front if `admitted` (see admitted()).
+    """
+    lane_token, admitted_token = _current_lane.set(name), _admitted.set(admitted)
+    try:
+        yield
+    finally:
+        _admitted.reset(admitted_token)
+        _current_lane.reset(lane_token)
+
+
+def current() -> tuple:
+    """The caller's (lane, admitted), for running work on its behalf with lane(*current())."""
+    return _current_lane.get(), _admitted.get()
+
+
+@contextmanager
+def admitted(name: str):
+    """
+    Admit a request that fans out into many LLM requests as a whole: it is rejected right away
+    when the lane's queue is full, otherwise the LLM requests made inside the block wait for
+    a slot in the lane without limit, like background ones. Callers bound their own fan-out.
+    """
+    if LLM_ADMISSION_CAPACITY:
+        controller = get_controller()
+        if controller.waiting(name) >= controller.queue:
+            controller._reject(name)
+    with lane(name, admitted=True):
+        yield
+
+
+class AdmissionController:
+    """
+    Concurrency budget for the LLM requests of one event loop. At most `capacity` requests
+    run at once and each lane at most its limit, so the lower lanes always leave room for
+    the higher ones. Requests over budget wait and are admitted highest lane first, oldest
+    first. Interactive and batch requests are rejected right away when `queue` requests of
+    their lane are already waiting, and after waiting `timeout` seconds, unless they were
+    admitted up front, see admitted().
+    """
+
+    def __init__(self, capacity, limits, queue, timeout):
+        self.capacity = capacity
+        self.limits = limits
+        self.queue = queue
+        self.timeout = timeout
+        self.active = dict.fromkeys(LANES, 0)
+        self.waiters = {name: collections.deque() for name in LANES}
+        self._hold = 1.0  # moving average of the seconds a request keeps its slot
+
+    def waiting(self, name) -> int:
+        return len(self.waiters[name])
+
+    @asynccontextmanager
+    async def slot(self, name):
+        await self._acquire(name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._hold = 0.9 * self._hold + 0.1 * (time.monotonic() - start)
+            self._release(name)
+
+    def retry_after(self, name) -> int:
+        """Seconds until the requests waiting at the lane's priority or above have likely been served."""
+        ahead = sum(len(self.waiters[other]) for other in LANES[:LANES.index(name) + 1])
+        return max(1, math.ceil(self._hold * (ahead + 1) / self.capacity))
+
+    def _has_room(self, name):
+        return sum(self.active.values()) < self.capacity and self.active[name] < self.limits[name]
+
+    async def _acquire(self, name):
+        # Waiters are woken whenever a slot frees up, so only the lane's own queue can be ahead.
+        if self._has_room(name) and not self.waiters[name]:
+            self.active[name] += 1
+            LLM_ADMISSIONS.inc(lane=name, outcome="admitted")
+            return
+        bounded = name != "background" and not _admitted.get()
+        if bounded and len(self.waiters[name]) >= self.queue:
+            self._reject(name)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[name].append(waiter)
+        LLM_ADMISSIONS.inc(lane=name, outcome="queued")
+        start = time.monotonic()
+        try:
+            await asyncio.wait({waiter}, timeout=self.timeout if bounded else None)
+        except asyncio.CancelledError:
+            self._abandon(name, waiter)
+            raise
+        if not waiter.done():
+            self._abandon(name, waiter)
+            self._reject(name)
+        LLM_ADMISSION_WAIT.observe(time.monotonic() - start, lane=name)
+
+    def _reject(self, name):
+        LLM_ADMISSIONS.inc(lane=name, outcome="rejected")
+        raise OverloadedError(name, self.retry_after(name))
+
+    def _abandon(self, name, waiter):
+        if waiter.done():
+            self._release(name)  # the slot was granted just before the caller gave up
+        else:
+            waiter.cancel()
+            self.waiters[name].remove(waiter)
+
+    def _release(self, name):
+        self.active[name] -= 1
+        self.wake()
+
+    def wake(self):
+        """Admit the waiters that fit now, highest lane first."""
+        for other in LANES:
+            queue = self.waiters[other]
+            while queue and self._has_room(other):
+                self.active[other] += 1
+                queue.popleft().set_result(None)
+
+
+# Futures are bound to their event loop, so every running loop gets its own controller.
+_controllers = {}
+
+
+def get_controller() -> AdmissionController:
+    loop = asyncio.get_running_loop()
+    controller = _controllers.get(loop)
+    if controller is None:
+        controller = _controllers[loop] = AdmissionController(
+            LLM_ADMISSION_CAPACITY, _limits, LLM_ADMISSION_QUEUE, LLM_ADMISSION_TIMEOUT
+        )
+        if LLM_ADMISSION_SYNC_INTERVAL > 0:
+            cluster_budget.start()
+    return controller
+
+
+@asynccontextmanager
+async def slot():
+    """Hold an LLM slot in the current lane; a no-op when admission control is disabled."""
+    if not LLM_ADMISSION_CAPACITY:
+        yield
+        return
+    async with get_controller().slot(_current_lane.get()):
+        yield
+
+
+def usage(name):
+    """Requests of the lane holding a slot and waiting for one in this process, over all event loops."""
+    controllers = list(_controllers.values())
+    return (
+        sum(controller.active[name] for controller in controllers),
+        sum(controller.waiting(name) for controller in controllers),
+    )
+
+
+def lane_limit(name) -> int:
+    """Requests of the lane this process may run at once."""
+    return _limits[name]
+
+
+def set_lane_limit(name, limit):
+    """Change a lane limit of this process; safe to call from any thread."""
+    if _limits[name] == limit:
+        return
+    _limits[name] = limit
+    for loop, controller in list(_controllers.items()):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(controller.wake)
+
+
+class ClusterBudget:
+    """
+    Ranks the background work of all processes sharing the LLM backends (API replicas, queue
+    workers, backfills) against their interactive and batch requests, which a per-process
+    budget can't do. Every `interval` seconds each process records the requests of its lanes
+    in llm_admission_usage and reads those of the other processes. While interactive or batch
+    requests wait in any other process, the background lane of this one is closed; otherwise
+    `limit` background slots are split evenly over the processes with background work.
+    If the table can't be reached, the configured per-process limit applies.
+    """
+
+    def __init__(self, interval=LLM_ADMISSION_SYNC_INTERVAL, limit=LLM_CLUSTER_BACKGROUND_LIMIT):
+        self.interval = interval
+        self.limit = limit
+        self.process = f"{socket.gethostname()}:{os.getpid()}"
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="admission-sync", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        failing = False
+        while True:
+            try:
+                set_lane_limit("background", self.sync())
+                failing = False
+            except Exception as e:
+                if not failing:
+                    logger.warning(f"Could not share the LLM budget with other processes: {e}")
+                failing = True
+                set_lane_limit("background", LLM_BACKGROUND_LANE_LIMIT)
+            time.sleep(self.interval)
+
+    def sync(self) -> int:
+        """Publish this process's usage and return its background limit."""
+        from db import engine  # db needs the database settings, which plain LLM clients don't
+
+        usage_by_lane = {name: usage(name) for name in LANES}
+        row = {
+            "process": self.process,
+            "interactive_waiting": usage_by_lane["interactive"][1],
+            "batch_waiting": usage_by_lane["batch"][1],
+            "background_active": usage_by_lane["background"][0],
+            "background_waiting": usage_by_lane["background"][1],
+        }
+        with engine.begin() as connection:
+            connection.execute(text(
+                "INSERT INTO llm_admission_usage (process, interactive_waiting, batch_waiting, background_active, "
+                "background_waiting, updated_at) VALUES (:process, :interactive_waiting, :batch_waiting, "
+                ":background_active, :background_waiting, timezone('utc', now())) "
+                "ON CONFLICT (process) DO UPDATE SET interactive_waiting = excluded.interactive_waiting, "
+                "batch_waiting = excluded.batch_waiting, background_active = excluded.background_active, "
+                "background_waiting = excluded.background_waiting, updated_at = excluded.updated_at"
+            ), row)
+            connection.execute(text(
+                "DELETE FROM llm_admission_usage "
+                "WHERE updated_at < timezone('utc', now()) - make_interval(secs => :expired)"
+            ), {"expired": 60 * self.interval})
+            higher_waiting, busy_processes = connection.execute(text(
+                "SELECT coalesce(sum(interactive_waiting + batch_waiting), 0), "
+                "count(*) FILTER (WHERE background_active + background_waiting > 0) "
+                "FROM llm_admission_usage "
+                "WHERE process != :process AND updated_at >= timezone('utc', now()) - make_interval(secs => :stale)"
+            ), {"process": self.process, "stale": 3 * self.interval}).one()
+        if higher_waiting:
+            return 0
+        return min(LLM_BACKGROUND_LANE_LIMIT, max(1, self.limit // (busy_processes + 1)))
+
+
+cluster_budget = ClusterBudget()
@@ -0,0 +1,351 @@
+import asyncio
+import functools
+import json
+import logging
+from contextlib import aclosing
+
+from batching import get_scheduler
+from cache import result_cache
+from chunking import chunk_text, estimate_tokens, combine_sentiments, combine_categories
+from config import ANALYSIS_MODE, LLM_BATCH_MODE, LLM_PARSE_RETRIES, PRECLASSIFIER_ENABLED, CHUNK_MAX_TOKENS
+from llm_client import query_llm, stream_llm, resolve_model
+from metrics import PARSE_FAILURES
+from parsing import (
+    CATEGORIES, AnalysisParseError, format_categories, parse_sentiment, parse_categories, typed_fields,
+    validate_sentiment, validate_categories,
+)
+from preclassifier import predict_sentiment, predict_category, TIER_LOCAL, TIER_LLM
+from prompts import CACHE_VERSION, PROMPTS, batch_profile, prompt_retry
+
+logger = logging.getLogger(__name__)
+
+
+def validate_analysis(data, output):
+    """
+    Validates one decoded answer of the combined prompt, accepting the same answers as the
+    separate prompts. Returns a (sentiment, category) tuple in the format stored in QueryResult.
+    """
+    try:
+        sentiment, categories = data["sentiment"], data["categories"]
+    except (TypeError, KeyError) as e:
+        raise AnalysisParseError(f"Invalid analysis output: {output!r}") from e
+    return str(validate_sentiment(sentiment, output)), format_categories(validate_categories(categories, output))
+
+
+def parse_analysis(output: str):
+    """Validates the output of the combined prompt, see validate_analysis."""
+    try:
+        data = json.loads(output)
+    except ValueError as e:
+        raise AnalysisParseError(f"Invalid analysis output: {output!r}") from e
+    return validate_analysis(data, output)
+
+
+def parse_batch_analysis(output: str, count: int):
+    """
+    Validates the output of the batch prompt.
+    Returns a list with a (sentiment, category) tuple, or None for every text the model
+    did not answer correctly.
+    """
+    try:
+        items = json.loads(output)["results"]
+        answers = {int(item["id"]): item for item in items}
+    except (ValueError, TypeError, KeyError) as e:
+        raise AnalysisParseError(f"Invalid batch analysis output: {output!r}") from e
+
+    results = []
+    for i in range(1, count + 1):
+        try:
+            results.append(validate_analysis(answers[i], output))
+        except (KeyError, AnalysisParseError):
+            results.append(None)
+    return results
+
+
+def normalize_sentiment(output: str) -> str:
+    return str(parse_sentiment(output))
+
+
+def normalize_categories(output: str) -> str:
+    return format_categories(parse_categories(output))
+
+
+# task -> (function normalizing an answer, reminder of the answer format used for retries)
+_ANSWER_FORMATS = {
+    "sentiment": (normalize_sentiment, "Answer with a single number: -1, 0 or 1."),
+    "category": (
+        normalize_categories,
+        "Answer with a JSON array of one to three of these categories: " + ", ".join(CATEGORIES) + ".",
+    ),
+}
+
+
+def complete_sentiment(output: str):
+    """Returns the answer once the streamed output is a complete sentiment, otherwise None."""
+    answer = output.strip().rstrip(".")
+    return answer if answer in ("-1", "0", "1") else None
+
+
+def complete_category(output: str):
+    """Returns the answer once the streamed output contains a complete, valid JSON array, otherwise None."""
+    start, end = output.find("["), output.find("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        return normalize_categories(output[start:end + 1])
+    except AnalysisParseError:
+        return None
+
+
+async def _query_parsed(task: str, text: str, model: str, output: str = None):
+    """
+    Queries the task's prompt, unless its output is given, and normalizes the answer. An answer that
+    can't be parsed is sent back to the model with a reminder of the expected format,
+    up to LLM_PARSE_RETRIES times.
+    """
+    profile = PROMPTS[task].profile
+    prompt = PROMPTS[task].render(text)
+    normalize, instruction = _ANSWER_FORMATS[task]
+    if output is None:
+        output = await query_llm(prompt, model=model, profile=profile)
+    for attempt in range(LLM_PARSE_RETRIES + 1):
+        try:
+            return normalize(output)
+        except AnalysisParseError:
+            PARSE_FAILURES.inc(task=task)
+            if attempt == LLM_PARSE_RETRIES:
+                raise
+            logger.warning(f"Invalid {task} output {output!r}, retrying")
+            retry = prompt_retry.format(prompt=prompt, output=output, instruction=instruction)
+            output = await query_llm(retry, model=model, profile=profile)
+
+
+async def _query_sentiment(text: str, model: str) -> str:
+    return await _query_parsed("sentiment", text, model)
+
+
+async def _query_category(text: str, model: str) -> str:
+    return await _query_parsed("category", text, model)
+
+
+async def _query_analysis(text: str, model: str):
+    prompt = PROMPTS["analysis"]
+    output = await query_llm(prompt.render(text), model=model, profile=prompt.profile)
+    try:
+        return parse_analysis(output)
+    except AnalysisParseError as e:
+        PARSE_FAILURES.inc(task="analysis")
+        logger.warning(f"{e}. Falling back to separate prompts.")
+        return await analyze_separately(text, model)
+
+
+async def _query_batch_analysis(texts, model: str):
+    numbered = "\n\n".join(f"{i}) {text}" for i, text in enumerate(texts, 1))
+    output = await query_llm(
+        PROMPTS["batch_analysis"].render(numbered), model=model, profile=batch_profile(len(texts))
+    )
+    try:
+        results = parse_batch_analysis(output, len(texts))
+    except AnalysisParseError:
+        PARSE_FAILURES.inc(task="batch_analysis")
+        raise
+    PARSE_FAILURES.inc(results.count(None), task="batch_analysis")
+    return results
+
+
+def _pick(index):
+    """Adapts the batch analysis to a task that needs only one of the two answers."""
+    async def run_many(texts, model):
+        return [
+            None if result is None else result[index]
+            for result in await _query_batch_analysis(texts, model)
+        ]
+    return run_many
+
+
+# Cache version of the answers of _infer. In 'multi' batch mode they come from the batch
+# prompt, so they are kept apart from the answers of the single-text prompts.
+_INFER_CACHE_VERSION = f"{CACHE_VERSION}-multi" if LLM_BATCH_MODE == "multi" else CACHE_VERSION
+
+# task -> (single text call, whole batch call)
+_TASKS = {
+    "sentiment": (_query_sentiment, _pick(0)),
+    "category": (_query_category, _pick(1)),
+    "analysis": (_query_analysis, _query_batch_analysis),
+}
+
+
+async def _infer(task: str, text: str, model: str):
+    """
+    Sends the text to the LLM directly or through the micro-batching scheduler.
+    Each model gets its own scheduler so a batch never mixes models.
+    """
+    run_one, run_many = _TASKS[task]
+    if LLM_BATCH_MODE == "off":
+        return await run_one(text, model)
+    run_one = functools.partial(run_one, model=model)
+    run_many = None if LLM_BATCH_MODE == "pipelined" else functools.partial(run_many, model=model)
+    return await get_scheduler(f"{task}:{model}", run_one, run_many).submit(text)
+
+
+async def analyze_sentiment(text: str, model: str = None) -> str:
+    """Returns the sentiment of the text as answered by the sentiment prompt."""
+    model = resolve_model(model)
+    return await result_cache.get_or_compute(
+        "sentiment", text, _INFER_CACHE_VERSION, model, lambda: _infer("sentiment", text, model)
+    )
+
+
+async def analyze_category(text: str, model: str = None) -> str:
+    """Returns the categories of the text as answered by the category prompt."""
+    model = resolve_model(model)
+    return await result_cache.get_or_compute(
+        "category", text, _INFER_CACHE_VERSION, model, lambda: _infer("category", text, model)
+    )
+
+
+async def analyze_separately(text: str, model: str = None):
+    """Runs the sentiment and category prompts as two independent LLM calls."""
+    sentiment, category = await asyncio.gather(analyze_sentiment(text, model), analyze_category(text, model))
+    return sentiment, category
+
+
+async def analyze_text(text: str, model: str = None):
+    """
+    Returns a (sentiment, category) tuple for the text.
+    In 'combined' mode both answers come from a single structured-output prompt,
+    falling back to the separate prompts if the output can't be parsed.
+    """
+    if ANALYSIS_MODE != "combined":
+        return await analyze_separately(text, model)
+
+    model = resolve_model(model)
+    sentiment, category = await result_cache.get_or_compute(
+        "analysis", text, _INFER_CACHE_VERSION, model, lambda: _infer("analysis", text, model)
+    )
+    return sentiment, category
+
+
+_PREDICTORS = {"sentiment": predict_sentiment, "category": predict_category}
+
+
+def _predict_locally(task: str, text: str):
+    return _PREDICTORS[task](text) if PRECLASSIFIER_ENABLED else None
+
+
+async def _classify_sentiment(text: str, model: str) -> dict:
+    sentiment = _predict_locally("sentiment", text)
+    if sentiment is not None:
+        return {"sentiment": sentiment, "sentiment_tier": TIER_LOCAL}
+    return {"sentiment": await analyze_sentiment(text, model), "sentiment_tier": TIER_LLM}
+
+
+async def _classify_category(text: str, model: str) -> dict:
+    category = _predict_locally("category", text)
+    if category is not None:
+        return {"category": category, "category_tier": TIER_LOCAL}
+    return {"category": await analyze_category(text, model), "category_tier": TIER_LLM}
+
+
+async def _classify_text(text: str, model: str) -> dict:
+    sentiment = _predict_locally("sentiment", text)
+    category = _predict_locally("category", text)
+    if sentiment is None and category is None:
+        sentiment, category = await analyze_text(text, model)
+        return {"sentiment": sentiment, "category": category, "sentiment_tier": TIER_LLM, "category_tier": TIER_LLM}
+    if sentiment is None:
+        return {**await _classify_sentiment(text, model), "category": category, "category_tier": TIER_LOCAL}
+    if category is None:
+        return {"sentiment": sentiment, "sentiment_tier": TIER_LOCAL, **await _classify_category(text, model)}
+    return {"sentiment": sentiment, "category": category, "sentiment_tier": TIER_LOCAL, "category_tier": TIER_LOCAL}
+
+
+async def _classify_chunked(text: str, classify, model: str) -> dict:
+    """
+    Map-reduce over a long text: classify the chunks concurrently (each chunk result is
+    cached on its own), then combine sentiments by a vote weighted by chunk length and
+    categories as the top-k union.
+    """
+    chunks = chunk_text(text)
+    results = await asyncio.gather(*(classify(chunk, model) for chunk in chunks))
+    weights = [estimate_tokens(chunk) for chunk in chunks]
+    fields = {}
+    if "sentiment" in results[0]:
+        fields["sentiment"] = combine_sentiments([result["sentiment"] for result in results], weights)
+    if "category" in results[0]:
+        fields["category"] = combine_categories([result["category"] for result in results], weights)
+    for column in list(fields):
+        tiers = {result[f"{column}_tier"] for result in results}
+        fields[f"{column}_tier"] = TIER_LOCAL if tiers == {TIER_LOCAL} else TIER_LLM
+    return fields
+
+
+async def _classify(text: str, classify, model: str) -> dict:
+    if estimate_tokens(text) > CHUNK_MAX_TOKENS:
+        return await _classify_chunked(text, classify, model)
+    return await classify(text, model)
+
+
+async def classify_sentiment(text: str, model: str = None) -> dict:
+    """
+    Returns {"sentiment": ..., "sentiment_tier": ..., "sentiment_value": ...}. Confident answers of the local
+    pre-classifier (when enabled) skip the LLM; long texts are analyzed in chunks.
+    """
+    return typed_fields(await _classify(text, _classify_sentiment, model))
+
+
+async def classify_category(text: str, model: str = None) -> dict:
+    """
+    Returns {"category": ..., "category_tier": ..., "category_mask": ...}. Confident answers of the local
+    pre-classifier (when enabled) skip the LLM; long texts are analyzed in chunks.
+    """
+    return typed_fields(await _classify(text, _classify_category, model))
+
+
+async def classify_text(text: str, model: str = None) -> dict:
+    """
+    Returns sentiment, category, their typed values and the tier of each answer, keyed by column name.
+    Only the answers the pre-classifier is unsure about are sent to the LLM;
+    long texts are analyzed in chunks.
+    """
+    return typed_fields(await _classify(text, _classify_text, model))
+
+
+# task -> function that recognizes a complete answer in a partial output
+_COMPLETE_ANSWERS = {"sentiment": complete_sentiment, "category": complete_category}
+_CLASSIFIERS = {"sentiment": _classify_sentiment, "category": _classify_category}
+
+
+async def stream_analysis(task: str, text: str, model: str = None):
+    """
+    Streams the sentiment or category prompt for the text.
+    Yields ("token", text) for every token and finally ("result", fields) with the answer
+    and the tier that gave it, keyed by column name. Generation is stopped as soon as the
+    output contains a complete answer; local and cached answers skip the LLM.
+    Long texts are analyzed in chunks as by classify_sentiment/classify_category, without tokens.
+    """
+    if estimate_tokens(text) > CHUNK_MAX_TOKENS:
+        yield "result", typed_fields(await _classify_chunked(text, _CLASSIFIERS[task], model))
+        return
+
+    result = _predict_locally(task, text)
+    if result is not None:
+        yield "result", typed_fields({task: result, f"{task}_tier": TIER_LOCAL})
+        return
+
+    model = resolve_model(model)
+    result = await result_cache.get(task, text, CACHE_VERSION, model)
+    if result is None:
+        prompt, complete = PROMPTS[task], _COMPLETE_ANSWERS[task]
+        output = ""
+        async with aclosing(stream_llm(prompt.render(text), model=model, profile=prompt.profile)) as tokens:
+            async for token in tokens:
+                output += token
+                yield "token", token
+                result = complete(output)
+                if result is not None:
+                    break
+        if result is None:
+            result = await _query_parsed(task, text, model, output=output)
+        await result_cache.set(task, text, CACHE_VERSION, model, result)
+    yield "result", typed_fields({task: result, f"{task}_tier": TIER_LLM})
@@ -0,0 +1,120 @@
+import base64
+import json
+from datetime import datetime, timezone
+
+from sqlalchemy import select, func, tuple_
+
+from orm_models import QueryResult, query_result_rollup
+from parsing import CATEGORIES, SENTIMENTS
+
+rollup = query_result_rollup.c
+INTERVALS = ("hour", "day", "week", "month")
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor can't be decoded."""
+
+
+def as_utc(moment):
+    """Timestamps are stored as naive UTC; aware query parameters are converted to that."""
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _rollup_filters(service=None, start=None, end=None):
+    filters = []
+    if service is not None:
+        filters.append(rollup.service == service)
+    if start is not None:
+        filters.append(rollup.bucket >= as_utc(start).replace(minute=0, second=0, microsecond=0))
+    if end is not None:
+        filters.append(rollup.bucket < as_utc(end))
+    return filters
+
+
+def _distributions(rows):
+    """Sentiment and category counts from (sentiment_value, category_mask, count) rows."""
+    sentiments = {str(value): 0 for value in SENTIMENTS}
+    categories = {category: 0 for category in CATEGORIES}
+    total = 0
+    for sentiment_value, mask, count in rows:
+        total += count
+        if sentiment_value is not None:
+            sentiments[str(sentiment_value)] += count
+        for i, category in enumerate(CATEGORIES):
+            if mask is not None and mask & (1 << i):
+                categories[category] += count
+    return {"total": total, "sentiments": sentiments, "categories": categories}
+
+
+async def summarize(db, service=None, start=None, end=None) -> dict:
+    """
+    Sentiment and category distributions from the rollup table.
+    The range is applied to whole hours: start is rounded down, end is exclusive.
+    """
+    query = (
+        select(rollup.sentiment_value, rollup.category_mask, func.sum(rollup.count))
+        .where(*_rollup_filters(service, start, end))
+        .group_by(rollup.sentiment_value, rollup.category_mask)
+    )
+    return _distributions((await db.execute(query)).all())
+
+
+async def timeseries(db, interval="day", service=None, start=None, end=None) -> list:
+    """Distributions per hour, day, week or month bucket, oldest first."""
+    bucket = func.date_trunc(interval, rollup.bucket).label("bucket")
+    query = (
+        select(bucket, rollup.sentiment_value, rollup.category_mask, func.sum(rollup.count))
+        .where(*_rollup_filters(service, start, end))
+        .group_by(bucket, rollup.sentiment_value, rollup.category_mask)
+        .order_by(bucket)
+    )
+    buckets = {}
+    for moment, sentiment_value, mask, count in (await db.execute(query)).all():
+        buckets.setdefault(moment, []).append((sentiment_value, mask, count))
+    return [{"bucket": moment, **_distributions(rows)} for moment, rows in buckets.items()]
+
+
+def encode_cursor(row) -> str:
+    raw = json.dumps([row.ts.isoformat(), row.ucid, row.service])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    try:
+        ts, ucid, service = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(ts), ucid, service
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError("Invalid cursor") from e
+
+
+async def list_results(db, service=None, start=None, end=None, category=None, sentiment=None,
+                       limit=100, cursor=None):
+    """
+    Stored results, newest first, filtered by service, ts range, category and sentiment.
+    Uses keyset pagination on (ts, ucid, service): pass the returned cursor to get the next page,
+    which is None after the last page.
+    """
+    query = select(QueryResult)
+    if service is not None:
+        query = query.where(QueryResult.service == service)
+    if start is not None:
+        query = query.where(QueryResult.ts >= as_utc(start))
+    if end is not None:
+        query = query.where(QueryResult.ts < as_utc(end))
+    if category is not None:
+        query = query.where(QueryResult.category_mask.op("&")(1 << CATEGORIES.index(category)) != 0)
+    if sentiment is not None:
+        query = query.where(QueryResult.sentiment_value == sentiment)
+    if cursor is not None:
+        query = query.where(
+            tuple_(QueryResult.ts, QueryResult.ucid, QueryResult.service) < tuple_(*decode_cursor(cursor))
+        )
+    query = query.order_by(
+        QueryResult.ts.desc(), QueryResult.ucid.desc(), QueryResult.service.desc()
+    ).limit(limit + 1)
+
+    rows = (await db.execute(query)).scalars().all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
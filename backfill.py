@@ -0,0 +1,213 @@
+"""
+Re-analyzes stored query results, e.g. after a prompt or model change.
+
+    python -m backfill --only-missing --concurrency 32 --rate 50
+    python -m backfill --service video_ocr --since 2025-01-01 --dry-run
+    python -m backfill --stub-llm --limit 1000
+
+Rows are streamed through a server-side cursor in primary key order and analyzed through the
+usual path (pre-classifier, cache, batching, LLM router). Results are written back with one bulk
+upsert per batch, after which the last key is saved to the checkpoint file, so an interrupted
+run continues where it stopped with --resume.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import select, func, or_, tuple_
+
+import analysis
+import llm_client
+from cache import result_cache
+from db import async_engine, AsyncSessionLocal
+from orm_models import QueryResult
+from persistence import save_query_results_async
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("backfill")
+
+TASKS = {"analysis": "classify_text", "sentiment": "classify_sentiment", "category": "classify_category"}
+
+
+class RateLimiter:
+    """Spaces calls evenly so that at most `rate` start per second; 0 means unlimited."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        start = max(self._next, now)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="backfill", description="Re-analyze stored query results.")
+    parser.add_argument("--task", choices=TASKS, default="analysis", help="what to recompute")
+    parser.add_argument("--model", help="model to use, as for the API 'model' parameter")
+    parser.add_argument("--service", help="only rows of this service")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only rows with ts >= SINCE")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="only rows with ts < UNTIL")
+    parser.add_argument("--only-missing", action="store_true", help="only rows without typed results")
+    parser.add_argument("--limit", type=int, help="stop after this many rows")
+    parser.add_argument("--batch-size", type=int, default=500, help="rows fetched, analyzed and written at a time")
+    parser.add_argument("--concurrency", type=int, default=16, help="texts analyzed at the same time")
+    parser.add_argument("--rate", type=float, default=0, help="max texts started per second, 0 for no limit")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the result cache")
+    parser.add_argument("--checkpoint", default="backfill.checkpoint.json", help="progress file")
+    parser.add_argument("--resume", action="store_true", help="continue after the key in the checkpoint file")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="count the rows and time a sample without writing anything")
+    parser.add_argument("--sample", type=int, default=50, help="rows analyzed by --dry-run")
+    parser.add_argument("--stub-llm", action="store_true", help="answer with the local stub instead of an LLM")
+    parser.add_argument("--stub-latency", type=float, default=0.05, help="seconds per stub answer")
+    return parser.parse_args(argv)
+
+
+def _filters(args) -> dict:
+    """The arguments that select rows; a checkpoint is only valid for the same selection."""
+    return {
+        "task": args.task, "model": args.model, "service": args.service, "only_missing": args.only_missing,
+        "since": args.since and args.since.isoformat(), "until": args.until and args.until.isoformat(),
+    }
+
+
+def load_checkpoint(args):
+    if not args.resume or not os.path.exists(args.checkpoint):
+        return {"filters": _filters(args), "last_key": None, "processed": 0, "failed": 0}
+    with open(args.checkpoint) as f:
+        checkpoint = json.load(f)
+    if checkpoint["filters"] != _filters(args):
+        raise SystemExit(f"{args.checkpoint} was written for other filters: {checkpoint['filters']}")
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically, so an interruption never leaves a partial file."""
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def build_query(args, after=None, count=False):
+    query = select(func.count()) if count else select(QueryResult.ucid, QueryResult.service, QueryResult.text)
+    query = query.select_from(QueryResult)
+    if args.service:
+        query = query.where(QueryResult.service == args.service)
+    if args.since:
+        query = query.where(QueryResult.ts >= args.since)
+    if args.until:
+        query = query.where(QueryResult.ts < args.until)
+    if args.only_missing:
+        query = query.where(or_(QueryResult.sentiment_value.is_(None), QueryResult.category_mask.is_(None)))
+    if after:
+        query = query.where(tuple_(QueryResult.ucid, QueryResult.service) > tuple_(*after))
+    if not count:
+        query = query.order_by(QueryResult.ucid, QueryResult.service)
+        if args.limit:
+            query = query.limit(args.limit)
+    return query
+
+
+async def analyze_rows(rows, classify, args, limiter, semaphore):
+    """Analyze the rows concurrently; returns the rows to upsert and the number of failures."""
+    async def analyze(row):
+        async with semaphore:
+            await limiter.wait()
+            return await classify(row.text, args.model)
+
+    outcomes = await asyncio.gather(*(analyze(row) for row in rows), return_exceptions=True)
+    updates = []
+    for row, outcome in zip(rows, outcomes):
+        if isinstance(outcome, Exception):
+            logger.warning(f"Failed to analyze {row.ucid}/{row.service}: {outcome}")
+        else:
+            updates.append({"ucid": row.ucid, "service": row.service, "text": row.text, **outcome})
+    return updates, len(rows) - len(updates)
+
+
+async def dry_run(args, classify):
+    async with async_engine.connect() as connection:
+        total = (await connection.execute(build_query(args, count=True))).scalar()
+        sample_args = argparse.Namespace(**{**vars(args), "limit": args.sample})
+        rows = (await connection.execute(build_query(sample_args))).all()
+    if args.limit:
+        total = min(total, args.limit)
+
+    start = time.perf_counter()
+    updates, failed = await analyze_rows(
+        rows, classify, args, RateLimiter(args.rate), asyncio.Semaphore(args.concurrency)
+    )
+    elapsed = time.perf_counter() - start
+    throughput = len(rows) / elapsed if rows and elapsed else 0
+    report = {
+        "rows": total,
+        "sampled": len(rows),
+        "sample_failures": failed,
+        "rows_per_second": round(throughput, 2),
+        "estimated_seconds": round(total / throughput) if throughput else None,
+    }
+    print(json.dumps(report))
+
+
+async def backfill(args, classify):
+    checkpoint = load_checkpoint(args)
+    if checkpoint["last_key"]:
+        logger.info(f"Resuming after {checkpoint['last_key']}, {checkpoint['processed']} rows done")
+    limiter = RateLimiter(args.rate)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    start = time.perf_counter()
+    processed = 0
+
+    async with async_engine.connect() as connection:
+        result = await connection.stream(
+            build_query(args, after=checkpoint["last_key"]).execution_options(yield_per=args.batch_size)
+        )
+        async for rows in result.partitions():
+            updates, failed = await analyze_rows(rows, classify, args, limiter, semaphore)
+            if updates:
+                async with AsyncSessionLocal() as db:
+                    await save_query_results_async(db, updates)
+
+            processed += len(rows)
+            checkpoint.update(
+                last_key=[rows[-1].ucid, rows[-1].service],
+                processed=checkpoint["processed"] + len(rows),
+                failed=checkpoint["failed"] + failed,
+            )
+            save_checkpoint(args.checkpoint, checkpoint)
+            logger.info(
+                f"{checkpoint['processed']} rows done, {checkpoint['failed']} failed, "
+                f"{processed / (time.perf_counter() - start):.1f} rows/s"
+            )
+    logger.info(f"Backfill finished: {checkpoint['processed']} rows, {checkpoint['failed']} failed")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.stub_llm:
+        llm_client.use_backends([{"type": "stub", "latency": args.stub_latency}])
+    if args.no_cache or args.dry_run:
+        result_cache.enabled = False  # a dry run must not fill the cache either
+    classify = getattr(analysis, TASKS[args.task])
+
+    async def run():
+        try:
+            await (dry_run if args.dry_run else backfill)(args, classify)
+        finally:
+            await llm_client.close_client()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+
+import admission
+from config import LLM_BATCH_WINDOW, LLM_BATCH_MAX_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """
+    Gathers texts submitted within a short window (or until max_batch texts are waiting)
+    and dispatches them together.
+
+    run_one(text) analyzes a single text. run_many(texts), if given, analyzes the whole
+    batch in one LLM call and returns a list with a result or None per text; texts it
+    could not answer, or every text if it raises, go through run_one concurrently instead.
+    Without run_many the batch is sent as concurrent pipelined requests.
+    The LLM requests of a batch run in the admission lane given as `lane` ((lane, admitted),
+    see admission.lane), so callers of different lanes need schedulers of their own.
+    """
+
+    def __init__(self, run_one, run_many=None, window=LLM_BATCH_WINDOW, max_batch=LLM_BATCH_MAX_SIZE,
+                 lane=("background", False)):
+        self.run_one = run_one
+        self.run_many = run_many
+        self.window = window
+        self.max_batch = max_batch
+        self.lane = lane
+        self._pending = []
+        self._timer = None
+        self._dispatching = set()  # the event loop only keeps weak references to tasks
+
+    async def submit(self, text: str):
+        """Queue a text for the next batch and wait for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch):
+        with admission.lane(*self.lane):
+            await self._run(batch)
+
+    async def _run(self, batch):
+        texts = [text for text, _ in batch]
+        results = [None] * len(batch)
+        if self.run_many is not None and len(batch) > 1:
+            try:
+                results = await self.run_many(texts)
+            except Exception as e:
+                logger.warning(f"Batch of {len(batch)} texts failed, falling back to single requests: {e}")
+
+        retry = [i for i, result in enumerate(results) if result is None]
+        retried = await asyncio.gather(*(self.run_one(texts[i]) for i in retry), return_exceptions=True)
+        for i, result in zip(retry, retried):
+            results[i] = result
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+# Futures and timers belong to the loop that created them, so schedulers are kept per loop,
+# and per admission lane so a batch never runs in the lane of another caller.
+_schedulers = {}
+
+
+def get_scheduler(name: str, run_one, run_many=None) -> BatchScheduler:
+    """Return the scheduler registered under the name for the currently running event loop and lane."""
+    lane = admission.current()
+    key = (asyncio.get_running_loop(), name, lane)
+    scheduler = _schedulers.get(key)
+    if scheduler is None:
+        scheduler = _schedulers[key] = BatchScheduler(run_one, run_many, lane=lane)
+    return scheduler
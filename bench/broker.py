@@ -0,0 +1,183 @@
+import collections
+import itertools
+import threading
+from types import SimpleNamespace
+
+from rabbit.rabbitmq import RabbitMQ
+
+
+class InMemoryBroker:
+    """
+    Broker stand-in holding queues in memory. It implements the part of pika's
+    BlockingConnection and BlockingChannel API used by RabbitMQ and Publisher:
+    declare, publish, transactions, consume with prefetch, ack, nack and requeue.
+    """
+
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.published = collections.Counter()
+        self.condition = threading.Condition()
+
+    def put(self, queue_name, body, properties=None, redelivered=False):
+        with self.condition:
+            self.queues[queue_name].append((body, properties, redelivered))
+            self.published[queue_name] += 1
+            self.condition.notify_all()
+
+    def connection(self):
+        return InMemoryConnection(self)
+
+
+class InMemoryConnection:
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        self.is_closed = False
+        self._channels = []
+        self._callbacks = collections.deque()
+
+    @property
+    def is_open(self):
+        return not self.is_closed
+
+    def channel(self):
+        channel = InMemoryChannel(self)
+        self._channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        with self.broker.condition:
+            self._callbacks.append(callback)
+            self.broker.condition.notify_all()
+
+    def process_data_events(self, time_limit=0):
+        """Run thread-safe callbacks and deliver the messages prefetch allows, waiting up to time_limit for work."""
+        with self.broker.condition:
+            if not self._callbacks and not self._deliveries_ready():
+                self.broker.condition.wait(time_limit)
+        while self._callbacks:
+            self._callbacks.popleft()()
+        for channel in self._channels:
+            while channel.is_open:
+                with self.broker.condition:
+                    delivery = channel._next_delivery()
+                if delivery is None:
+                    break
+                callback, method, properties, body = delivery
+                callback(channel, method, properties, body)
+
+    def _deliveries_ready(self):
+        return any(channel.is_open and channel._can_deliver() for channel in self._channels)
+
+    def close(self):
+        self.is_closed = True
+
+
+class InMemoryChannel:
+    def __init__(self, connection: InMemoryConnection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_closed = False
+        self.prefetch_count = 0
+        self.global_prefetch_count = 0
+        self._consumers = []
+        self._unacked = {}
+        self._tags = itertools.count(1)
+        self._transaction = None
+        self._consuming = False
+
+    @property
+    def is_open(self):
+        return not self.is_closed
+
+    def queue_declare(self, queue, passive=False, **kwargs):
+        with self.broker.condition:
+            message_count = len(self.broker.queues[queue])
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=message_count))
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        if global_qos:
+            self.global_prefetch_count = prefetch_count
+        else:
+            self.prefetch_count = prefetch_count
+
+    def _prefetch_full(self):
+        """Per-consumer limits are approximated by their sum, as a channel-wide one."""
+        limits = [self.prefetch_count * len(self._consumers), self.global_prefetch_count]
+        return any(limit and len(self._unacked) >= limit for limit in limits)
+
+    def tx_select(self):
+        self._transaction = []
+
+    def tx_commit(self):
+        messages, self._transaction = self._transaction, []
+        for message in messages:
+            self.broker.put(*message)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if self._transaction is not None:
+            self._transaction.append((routing_key, body, properties))
+        else:
+            self.broker.put(routing_key, body, properties)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self._consumers.append((queue, on_message_callback, auto_ack))
+        return queue  # consumer tag
+
+    def basic_cancel(self, consumer_tag):
+        self._consumers = [consumer for consumer in self._consumers if consumer[0] != consumer_tag]
+        return []
+
+    def basic_ack(self, delivery_tag):
+        with self.broker.condition:
+            self._unacked.pop(delivery_tag)
+            self.broker.condition.notify_all()
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        with self.broker.condition:
+            queue_name, body, properties = self._unacked.pop(delivery_tag)
+            self.broker.condition.notify_all()
+        if requeue:
+            self.broker.put(queue_name, body, properties, redelivered=True)
+
+    def stop_consuming(self):
+        self._consuming = False
+
+    def _can_deliver(self):
+        if self._prefetch_full():
+            return False
+        return any(self.broker.queues[queue_name] for queue_name, _, _ in self._consumers)
+
+    def _next_delivery(self):
+        """A message from one of the consumed queues, if prefetch allows another one."""
+        if self._prefetch_full():
+            return None
+        for queue_name, callback, auto_ack in self._consumers:
+            if self.broker.queues[queue_name]:
+                body, properties, redelivered = self.broker.queues[queue_name].popleft()
+                tag = next(self._tags)
+                if not auto_ack:
+                    self._unacked[tag] = (queue_name, body, properties)
+                method = SimpleNamespace(delivery_tag=tag, redelivered=redelivered, routing_key=queue_name)
+                return callback, method, properties, body
+        return None
+
+    def start_consuming(self):
+        """Deliver messages and run thread-safe callbacks on this thread until stop_consuming()."""
+        self._consuming = True
+        while self._consuming:
+            self.connection.process_data_events(time_limit=0.1)
+
+    def close(self):
+        self.is_closed = True
+
+
+class InMemoryRabbitMQ(RabbitMQ):
+    """RabbitMQ wrapper connected to an InMemoryBroker instead of a server."""
+
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        super().__init__()
+
+    def create_connection(self):
+        if not self.connection or self.connection.is_closed:
+            self.connection = self.broker.connection()
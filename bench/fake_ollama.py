@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+import json
+import re
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from stub_llm import answer
+
+_token = re.compile(r"\s*\S{1,4}")
+
+
+def create_app(latency=0.2, token_rate=50.0) -> FastAPI:
+    """
+    Ollama stand-in serving /api/generate and /api/tags. Each answer starts after `latency`
+    seconds and is generated at `token_rate` tokens per second, with or without streaming.
+    Answers come from stub_llm, so they are well-formed and deterministic.
+    """
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": "stub"}]}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        payload = await request.json()
+        if "prompt" not in payload:  # a warm-up request only loads the model
+            return {"model": payload["model"], "response": "", "done": True}
+        app.state.requests += 1
+        tokens = _token.findall(answer(payload["prompt"]))[:payload.get("options", {}).get("num_predict")]
+        if not payload.get("stream", True):
+            await asyncio.sleep(latency + (len(tokens) / token_rate if token_rate else 0))
+            return {"model": payload["model"], "response": "".join(tokens), "done": True}
+
+        async def lines():
+            await asyncio.sleep(latency)
+            for token in tokens:
+                if token_rate:
+                    await asyncio.sleep(1 / token_rate)
+                yield json.dumps({"model": payload["model"], "response": token, "done": False}) + "\n"
+            yield json.dumps({"model": payload["model"], "response": "", "done": True}) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    return app
+
+
+def serve_in_thread(app, port: int) -> uvicorn.Server:
+    """Run an ASGI app with uvicorn on a daemon thread and wait until it accepts connections."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name=f"uvicorn-{port}", daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Ollama stand-in for benchmarks.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="tokens per second, 0 for instant")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.token_rate), host="0.0.0.0", port=args.port)
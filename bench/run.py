@@ -0,0 +1,292 @@
+"""
+Benchmarks the API and the queue consumer against a local Ollama stand-in.
+
+    python -m bench.run --concurrency 1,8,32 --requests 400 --output bench_results.json
+    python -m bench.run --scenario consumer --llm-latency 0.5 --baseline bench_results.json
+
+The LLM is replaced by bench.fake_ollama (configurable latency and token rate) and RabbitMQ by
+bench.broker, so no GPU or broker is needed. Results are written to the database configured by
+DATABASE_URL, so run it against a scratch Postgres (e.g. the docker-compose one).
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+import httpx
+import pika
+
+import llm_client
+import rabbit.publisher
+from bench.broker import InMemoryBroker, InMemoryRabbitMQ
+from bench.fake_ollama import create_app, serve_in_thread
+from db import engine
+from migrations import run_migrations
+from orm_models import Base
+from config import OLLAMA_MODEL, ANALYSIS_MODE, LLM_BATCH_MODE, PRECLASSIFIER_ENABLED, CACHE_ENABLED
+from metrics import DB_ROWS_WRITTEN, DB_COMMIT_LATENCY
+
+WORDS = (
+    "great terrible game match election phone movie market climate doctor engine team song price "
+    "new old fast slow love hate today really very not quite the a of and with about"
+).split()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="bench.run", description="Benchmark the API and the consumer.")
+    parser.add_argument("--scenario", choices=("api", "consumer", "all"), default="all")
+    parser.add_argument("--endpoints", default="/sentiment,/categories", help="comma-separated API paths")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests or messages per run")
+    parser.add_argument("--unique-ratio", type=float, default=1.0,
+                        help="share of distinct texts in a run; lower values exercise the cache")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake LLM seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="fake LLM tokens per second")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    return parser.parse_args(argv)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def summarize_latencies(latencies) -> dict:
+    """Mean and nearest-rank percentiles in milliseconds."""
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2)
+
+    return {
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50": percentile(50), "p95": percentile(95), "p99": percentile(99),
+        "max": round(ordered[-1] * 1000, 2),
+    }
+
+
+def make_texts(count, unique_ratio, rng):
+    """Random short texts; each run gets its own prefix so runs don't hit each other's cache entries."""
+    tag = uuid.uuid4().hex[:8]
+    distinct = [
+        f"{tag} " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))
+        for _ in range(max(1, round(count * unique_ratio)))
+    ]
+    return [distinct[i % len(distinct)] for i in range(count)]
+
+
+class Probe:
+    """Deltas of DB writes and fake LLM requests over one run."""
+
+    def __init__(self, llm_app):
+        self.llm_app = llm_app
+        self.start = time.perf_counter()
+        self.rows = DB_ROWS_WRITTEN.value()
+        self.commits = DB_COMMIT_LATENCY.count()
+        self.llm_requests = llm_app.state.requests
+
+    def result(self, completed, errors, latencies, **extra) -> dict:
+        duration = time.perf_counter() - self.start
+        return {
+            **extra,
+            "completed": completed,
+            "errors": errors,
+            "duration_s": round(duration, 3),
+            "throughput_per_s": round(completed / duration, 2),
+            "latency_ms": summarize_latencies(latencies),
+            "db_rows_per_s": round((DB_ROWS_WRITTEN.value() - self.rows) / duration, 2),
+            "db_commits_per_s": round((DB_COMMIT_LATENCY.count() - self.commits) / duration, 2),
+            "llm_requests": self.llm_app.state.requests - self.llm_requests,
+        }
+
+
+async def drive_endpoint(base_url, path, texts, concurrency):
+    """Closed loop: `concurrency` clients send the texts one request at a time."""
+    latencies, errors = [], 0
+    pending = iter(texts)
+
+    async def client(http):
+        nonlocal errors
+        for text in pending:
+            started = time.perf_counter()
+            try:
+                response = await http.post(path, json={"ucid": f"bench-{uuid.uuid4().hex}", "service": "bench", "text": text})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as http:
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+    return latencies, errors
+
+
+def run_api(args, llm_app, rng):
+    import main as api
+
+    port = free_port()
+    server = serve_in_thread(api.app, port)
+    results = []
+    try:
+        for path in args.endpoints.split(","):
+            for concurrency in args.concurrency_levels:
+                texts = make_texts(args.requests, args.unique_ratio, rng)
+                probe = Probe(llm_app)
+                latencies, errors = asyncio.run(drive_endpoint(f"http://127.0.0.1:{port}", path, texts, concurrency))
+                results.append(probe.result(
+                    len(latencies), errors, latencies, scenario="api", target=path, concurrency=concurrency,
+                ))
+                print(format_result(results[-1]))
+    finally:
+        server.should_exit = True
+    return results
+
+
+def run_consumer(args, llm_app, rng):
+    """Drain a backlog of video_ocr messages through the concurrent consumer and the publisher."""
+    from rabbit.callbacks import callback_video_ocr
+
+    results = []
+    for concurrency in args.concurrency_levels:
+        broker = InMemoryBroker()
+        rabbit.publisher._publisher = rabbit.publisher.Publisher(rabbit=InMemoryRabbitMQ(broker))
+        queue_name = "bench_video_ocr"
+        texts = make_texts(args.requests, args.unique_ratio, rng)
+        published_at, latencies, processing = {}, [], []
+        lock, done, failed = threading.Lock(), threading.Event(), [0]
+
+        consumer = InMemoryRabbitMQ(broker)
+
+        def finish(latency=None, duration=None):
+            with lock:
+                if latency is None:
+                    failed[0] += 1
+                else:
+                    latencies.append(latency)
+                    processing.append(duration)
+                if len(latencies) + failed[0] >= len(texts):
+                    done.set()
+                    consumer.stop()
+
+        def callback(ch, method, properties, body):
+            started = time.perf_counter()
+            try:
+                callback_video_ocr(ch, method, properties, body)
+            except Exception:
+                finish()  # the consumer moves it to the retry queue, which the in-memory broker never hands back
+                raise
+            finished = time.perf_counter()
+            finish(finished - published_at[json.loads(body)["UCID"]], finished - started)
+
+        probe = Probe(llm_app)
+        for text in texts:
+            ucid = f"bench-{uuid.uuid4().hex}"
+            published_at[ucid] = time.perf_counter()
+            properties = pika.BasicProperties(delivery_mode=2, timestamp=int(time.time()))
+            broker.put(queue_name, json.dumps({"UCID": ucid, "text": text}), properties)
+        thread = threading.Thread(
+            target=consumer.start_concurrent_consumers,
+            args=([(queue_name, callback)], 2 * concurrency, concurrency),
+            daemon=True,
+        )
+        thread.start()
+        done.wait()
+        thread.join()
+        rabbit.publisher._publisher.close()
+
+        results.append(probe.result(
+            len(latencies), failed[0], latencies, scenario="consumer", target=queue_name,
+            concurrency=concurrency, processing_ms=summarize_latencies(processing),
+            published=broker.published["text_ai_to_analyze"],
+        ))
+        print(format_result(results[-1]))
+    return results
+
+
+def format_result(result) -> str:
+    latency = result["latency_ms"]
+    return (
+        f"{result['scenario']:>8} {result['target']:<16} c={result['concurrency']:<4} "
+        f"{result['throughput_per_s']:>8.1f}/s  p50={latency.get('p50')}ms p95={latency.get('p95')}ms "
+        f"p99={latency.get('p99')}ms  errors={result['errors']}  db_rows/s={result['db_rows_per_s']}  "
+        f"llm_requests={result['llm_requests']}"
+    )
+
+
+def compare(results, baseline_path):
+    """Print throughput and p95 changes against the matching runs of an earlier report."""
+    with open(baseline_path) as f:
+        baseline = {
+            (run["scenario"], run["target"], run["concurrency"]): run for run in json.load(f)["results"]
+        }
+    for run in results:
+        before = baseline.get((run["scenario"], run["target"], run["concurrency"]))
+        if not before or not before["throughput_per_s"] or not before["latency_ms"]:
+            continue
+        throughput = (run["throughput_per_s"] / before["throughput_per_s"] - 1) * 100
+        p95 = (run["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1) * 100
+        print(f"{run['scenario']:>8} {run['target']:<16} c={run['concurrency']:<4} "
+              f"throughput {throughput:+.1f}%  p95 {p95:+.1f}%")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    args.concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    rng = random.Random(args.seed)
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+
+    llm_app = create_app(args.llm_latency, args.token_rate)
+    llm_port = free_port()
+    llm_server = serve_in_thread(llm_app, llm_port)
+    llm_client.use_backends([{
+        "name": "fake-ollama", "type": "ollama",
+        "url": f"http://127.0.0.1:{llm_port}/api/generate", "models": [OLLAMA_MODEL],
+    }])
+
+    results = []
+    try:
+        if args.scenario in ("api", "all"):
+            results += run_api(args, llm_app, rng)
+        if args.scenario in ("consumer", "all"):
+            results += run_consumer(args, llm_app, rng)
+    finally:
+        llm_server.should_exit = True
+
+    report = {
+        "revision": git_revision(),
+        "config": {
+            "requests": args.requests, "unique_ratio": args.unique_ratio,
+            "llm_latency": args.llm_latency, "token_rate": args.token_rate,
+            "analysis_mode": ANALYSIS_MODE, "llm_batch_mode": LLM_BATCH_MODE,
+            "preclassifier": PRECLASSIFIER_ENABLED, "cache": CACHE_ENABLED,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    run()
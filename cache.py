@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from sqlalchemy.dialects.postgresql import insert
+
+from config import (
+    CACHE_ENABLED, CACHE_MAX_SIZE, CACHE_TTL, CACHE_PERSISTENT, SINGLEFLIGHT_ADVISORY_LOCK, NEAR_DUPLICATE_ENABLED,
+    NEAR_DUPLICATE_TASKS,
+)
+from db import AsyncSessionLocal
+from metrics import CACHE_LOOKUPS
+from near_duplicates import NearDuplicateIndex
+from orm_models import CachedResult
+from singleflight import SingleFlight, async_process_lock
+
+logger = logging.getLogger(__name__)
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize unicode and whitespace so trivially different copies of a text share a key."""
+    return _whitespace.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def make_key(task: str, text: str, prompt_version, model: str) -> str:
+    raw = f"{task}\x00{prompt_version}\x00{model}\x00{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry time to live."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResultCache:
+    """
+    Two-tier cache for LLM results: an in-process LRU in front of the llm_cache table.
+    Values are stored as JSON so tuples of results can be cached as well.
+    With near_duplicates, a miss in both tiers of one of the near_duplicate_tasks falls back
+    to the result of a similar text analyzed by this process.
+    """
+
+    def __init__(self, maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL, persistent=CACHE_PERSISTENT, enabled=CACHE_ENABLED,
+                 near_duplicates=NEAR_DUPLICATE_ENABLED, near_duplicate_tasks=NEAR_DUPLICATE_TASKS):
+        self.enabled = enabled
+        self.persistent = persistent
+        self.memory = LRUCache(maxsize, ttl)
+        self.near_duplicates = NearDuplicateIndex() if near_duplicates else None
+        self.near_duplicate_tasks = set(near_duplicate_tasks)
+        self.in_flight = SingleFlight("llm")
+
+    async def _load(self, key):
+        async with AsyncSessionLocal() as db:
+            record = await db.get(CachedResult, key)
+            return record.value if record else None
+
+    async def _store(self, key, task, model, value):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                insert(CachedResult)
+                .values(key=key, task=task, model=model, value=value)
+                .on_conflict_do_nothing(index_elements=["key"])
+            )
+            await db.commit()
+
+    async def get(self, task: str, text: str, prompt_version, model: str):
+        """
+        Returns the cached result for the text, or None on a miss.
+        Failures of the persistent tier are logged and never fail the request.
+        """
+        if not self.enabled:
+            return None
+
+        key = make_key(task, text, prompt_version, model)
+        value = self.memory.get(key)
+        if value is not None:
+            CACHE_LOOKUPS.inc(result="memory_hit")
+            return json.loads(value)
+
+        if self.persistent:
+            try:
+                value = await self._load(key)
+            except Exception as e:
+                logger.warning(f"Cache lookup failed: {e}")
+            if value is not None:
+                CACHE_LOOKUPS.inc(result="db_hit")
+                self.memory.set(key, value)
+                await self._index(key, task, text, prompt_version, model, value)
+                return json.loads(value)
+
+        if self._reuses_near_duplicates(task):
+            value = await asyncio.to_thread(self.near_duplicates.find, (task, prompt_version, model), text)
+            if value is not None:
+                CACHE_LOOKUPS.inc(result="near_hit")
+                self.memory.set(key, value)
+                return json.loads(value)
+
+        CACHE_LOOKUPS.inc(result="miss")
+        return None
+
+    async def set(self, task: str, text: str, prompt_version, model: str, result):
+        """Stores the result in both tiers."""
+        if not self.enabled:
+            return
+
+        key = make_key(task, text, prompt_version, model)
+        value = json.dumps(result)
+        self.memory.set(key, value)
+        await self._index(key, task, text, prompt_version, model, value)
+        if self.persistent:
+            try:
+                await self._store(key, task, model, value)
+            except Exception as e:
+                logger.warning(f"Cache store failed: {e}")
+
+    async def get_or_compute(self, task: str, text: str, prompt_version, model: str, compute):
+        """
+        Returns the cached result for the text, or awaits compute() and caches its result.
+        Concurrent misses for the same key share a single compute().
+        """
+        result = await self.get(task, text, prompt_version, model)
+        if result is None:
+            key = make_key(task, text, prompt_version, model)
+            result = await self.in_flight.do(
+                key, lambda: self._compute(key, task, text, prompt_version, model, compute)
+            )
+        return result
+
+    async def _compute(self, key, task, text, prompt_version, model, compute):
+        if not (self.enabled and self.persistent and SINGLEFLIGHT_ADVISORY_LOCK):
+            result = await compute()
+            await self.set(task, text, prompt_version, model, result)
+            return result
+
+        # Another process may have stored the result while this one waited for the lock.
+        async with async_process_lock(f"llm_cache:{key}"):
+            value = await self._load(key)
+            if value is not None:
+                self.memory.set(key, value)
+                await self._index(key, task, text, prompt_version, model, value)
+                return json.loads(value)
+            result = await compute()
+            await self.set(task, text, prompt_version, model, result)
+        return result
+
+    def _reuses_near_duplicates(self, task):
+        return self.near_duplicates is not None and task in self.near_duplicate_tasks
+
+    async def _index(self, key, task, text, prompt_version, model, value):
+        if self._reuses_near_duplicates(task):
+            await asyncio.to_thread(self.near_duplicates.add, key, (task, prompt_version, model), text, value)
+
+    def stats(self) -> dict:
+        return {
+            "memory_hits": CACHE_LOOKUPS.value(result="memory_hit"),
+            "db_hits": CACHE_LOOKUPS.value(result="db_hit"),
+            "near_duplicate_hits": CACHE_LOOKUPS.value(result="near_hit"),
+            "misses": CACHE_LOOKUPS.value(result="miss"),
+            "memory_size": len(self.memory),
+            "near_duplicate_size": len(self.near_duplicates) if self.near_duplicates is not None else 0,
+        }
+
+
+result_cache = ResultCache()
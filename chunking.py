@@ -0,0 +1,89 @@
+import json
+import re
+
+from config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_TOP_CATEGORIES
+
+_sentence_end = re.compile(r"(?<=[.!?…])\s+|\n+")
+_sentiment = re.compile(r"-?[01]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token for llama-style tokenizers)."""
+    return len(text) // 4 + 1
+
+
+def split_sentences(text: str, max_tokens=CHUNK_MAX_TOKENS):
+    """Split text into sentences, breaking sentences longer than max_tokens at word boundaries."""
+    for sentence in _sentence_end.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if estimate_tokens(sentence) <= max_tokens:
+            yield sentence
+            continue
+        part = []
+        for word in sentence.split():
+            if part and estimate_tokens(" ".join(part + [word])) > max_tokens:
+                yield " ".join(part)
+                part = []
+            part.append(word)
+        if part:
+            yield " ".join(part)
+
+
+def chunk_text(text: str, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Pack whole sentences into chunks of at most max_tokens tokens.
+    Each chunk starts with the last sentences of the previous one, up to overlap_tokens,
+    so that context spanning a boundary is not lost.
+    """
+    chunks = []
+    current = []
+    for sentence in split_sentences(text, max_tokens):
+        if current and estimate_tokens(" ".join(current + [sentence])) > max_tokens:
+            chunks.append(" ".join(current))
+            overlap = []
+            for previous in reversed(current):
+                if estimate_tokens(" ".join([previous] + overlap)) > overlap_tokens \
+                        or estimate_tokens(" ".join([previous] + overlap + [sentence])) > max_tokens:
+                    break
+                overlap.insert(0, previous)
+            current = overlap
+        current.append(sentence)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def combine_sentiments(sentiments, weights) -> str:
+    """
+    Weighted vote over the chunk sentiments: the answer with the largest total weight wins.
+    Unparseable answers are ignored; ties and texts without any answer are neutral.
+    """
+    totals = {"-1": 0, "0": 0, "1": 0}
+    for sentiment, weight in zip(sentiments, weights):
+        match = _sentiment.search(sentiment or "")
+        if match:
+            totals[str(int(match.group()))] += weight
+    best = max(totals.values())
+    winners = [sentiment for sentiment, total in totals.items() if total == best]
+    return winners[0] if len(winners) == 1 else "0"
+
+
+def combine_categories(categories, weights, top_k=CHUNK_TOP_CATEGORIES) -> str:
+    """
+    Union of the chunk categories ranked by total weight, keeping the top_k.
+    'Other' is kept only if no chunk found a specific category.
+    """
+    totals = {}
+    for answer, weight in zip(categories, weights):
+        try:
+            names = json.loads(answer[answer.index("["):answer.rindex("]") + 1])
+        except (ValueError, AttributeError):
+            continue
+        for name in names:
+            if isinstance(name, str):
+                totals[name] = totals.get(name, 0) + weight
+    pool = {name: total for name, total in totals.items() if name != "Other"} or totals or {"Other": 1}
+    ranked = sorted(pool, key=pool.get, reverse=True)
+    return json.dumps(ranked[:top_k], separators=(",", ":"))
@@ -11,3 +11,118 @@ RABBIT_PASSWORD = os.environ.get('RABBIT_PASSWORD')
 COMMENT_HANDLER_QUEUE = os.environ.get('COMMENT_HANDLER_QUEUE')
 VIDEO_OCR_TEXT_HANDLER_QUEUE = os.environ.get('VIDEO_OCR_TEXT_HANDLER_QUEUE')
 VIDEO_TEXT_EXTRACTION_QUEUE = os.environ.get('VIDEO_TEXT_EXTRACTION_QUEUE')
+
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://40.113.50.250:8080/llama/api/generate')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama3.1')
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))  # in-flight requests per backend
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', 5))
+LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', 120))
+LLM_POOL_TIMEOUT = float(os.environ.get('LLM_POOL_TIMEOUT', 30))
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', 32))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 16))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_KEEPALIVE_EXPIRY', 60))  # seconds
+
+ANALYSIS_MODE = os.environ.get('ANALYSIS_MODE', 'combined')  # 'combined' (one LLM call) or 'separate'
+
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_MAX_SIZE = int(os.environ.get('CACHE_MAX_SIZE', 10000))  # entries kept in the in-process LRU
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 3600))  # seconds an in-process entry stays valid
+CACHE_PERSISTENT = os.environ.get('CACHE_PERSISTENT', 'true').lower() == 'true'  # Postgres tier
+# Reuse the cached result of a near-duplicate text (e.g. OCR noise) when no exact entry exists
+NEAR_DUPLICATE_ENABLED = os.environ.get('NEAR_DUPLICATE_ENABLED', 'false').lower() == 'true'
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get('NEAR_DUPLICATE_THRESHOLD', 0.95))  # Jaccard of character 4-grams
+NEAR_DUPLICATE_MAX_SIZE = int(os.environ.get('NEAR_DUPLICATE_MAX_SIZE', 10000))  # texts kept in the in-process index
+NEAR_DUPLICATE_MIN_CHARS = int(os.environ.get('NEAR_DUPLICATE_MIN_CHARS', 40))  # shorter texts need an exact match
+NEAR_DUPLICATE_MAX_CHARS = int(os.environ.get('NEAR_DUPLICATE_MAX_CHARS', 2000))  # longer texts need an exact match
+# Tasks whose results may be reused; one changed word ("love" -> "hate") can flip a sentiment
+NEAR_DUPLICATE_TASKS = os.environ.get('NEAR_DUPLICATE_TASKS', 'category').split(',')
+
+RABBIT_CONSUMER_MODE = os.environ.get('RABBIT_CONSUMER_MODE', 'concurrent')  # 'concurrent' (manual acks) or 'blocking'
+RABBIT_PREFETCH_COUNT = int(os.environ.get('RABBIT_PREFETCH_COUNT', 16))
+RABBIT_WORKERS = int(os.environ.get('RABBIT_WORKERS', 8))  # messages processed at the same time
+RABBIT_PUBLISH_BATCH_SIZE = int(os.environ.get('RABBIT_PUBLISH_BATCH_SIZE', 100))
+RABBIT_PUBLISH_LINGER = float(os.environ.get('RABBIT_PUBLISH_LINGER', 0.005))  # seconds to wait for a batch to fill
+RABBIT_RECONNECT_MIN_DELAY = float(os.environ.get('RABBIT_RECONNECT_MIN_DELAY', 1))  # seconds, doubled per failure
+RABBIT_RECONNECT_MAX_DELAY = float(os.environ.get('RABBIT_RECONNECT_MAX_DELAY', 60))
+RABBIT_DRAIN_TIMEOUT = float(os.environ.get('RABBIT_DRAIN_TIMEOUT', 60))  # seconds to finish messages on shutdown
+RABBIT_RETRY_DELAY = float(os.environ.get('RABBIT_RETRY_DELAY', 30))  # seconds a failed message waits before it is retried
+RABBIT_MAX_RETRIES = int(os.environ.get('RABBIT_MAX_RETRIES', 120))  # then it is parked in <queue>.dead
+
+# Worker supervisor (python -m rabbit.supervisor): processes per queue, scaled by queue depth.
+# JSON object overriding the limits per queue, e.g. {"video_ocr": {"min": 1, "max": 8}}
+SUPERVISOR_QUEUE_WORKERS = os.environ.get('SUPERVISOR_QUEUE_WORKERS')
+SUPERVISOR_MIN_WORKERS = int(os.environ.get('SUPERVISOR_MIN_WORKERS', 1))
+SUPERVISOR_MAX_WORKERS = int(os.environ.get('SUPERVISOR_MAX_WORKERS', 4))
+SUPERVISOR_MESSAGES_PER_WORKER = int(os.environ.get('SUPERVISOR_MESSAGES_PER_WORKER', 50))  # backlog per process
+SUPERVISOR_SCALE_INTERVAL = float(os.environ.get('SUPERVISOR_SCALE_INTERVAL', 5))  # seconds between depth checks
+SUPERVISOR_SCALE_DOWN_DELAY = float(os.environ.get('SUPERVISOR_SCALE_DOWN_DELAY', 60))  # seconds of low depth
+
+# How long Ollama keeps the model loaded after a request, as a duration ("30m"; "-1m" keeps it loaded)
+LLM_KEEP_ALIVE = os.environ.get('LLM_KEEP_ALIVE', '30m')
+LLM_WARMUP = os.environ.get('LLM_WARMUP', 'true').lower() == 'true'  # load the model before taking traffic
+LLM_WARMUP_TIMEOUT = float(os.environ.get('LLM_WARMUP_TIMEOUT', 120))  # seconds startup waits for the model
+# JSON object overriding the generation profile of a prompt, e.g. {"category": {"max_tokens": 48}}
+LLM_PROFILES = os.environ.get('LLM_PROFILES')
+LLM_STRUCTURED_OUTPUT = os.environ.get('LLM_STRUCTURED_OUTPUT', 'false').lower() == 'true'  # JSON schemas, Ollama 0.5+
+
+LLM_PARSE_RETRIES = int(os.environ.get('LLM_PARSE_RETRIES', 2))  # re-asks after an answer in the wrong format
+
+LLM_BATCH_MODE = os.environ.get('LLM_BATCH_MODE', 'off')  # 'off', 'pipelined' or 'multi' (one prompt per batch)
+LLM_BATCH_WINDOW = float(os.environ.get('LLM_BATCH_WINDOW', 0.01))  # seconds to gather a batch
+LLM_BATCH_MAX_SIZE = int(os.environ.get('LLM_BATCH_MAX_SIZE', 8))
+
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))  # items accepted by the /batch endpoints
+
+WRITE_BUFFER_MAX_ROWS = int(os.environ.get('WRITE_BUFFER_MAX_ROWS', 200))  # rows per bulk upsert
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.environ.get('WRITE_BUFFER_FLUSH_INTERVAL', 0.05))  # seconds
+
+PRECLASSIFIER_ENABLED = os.environ.get('PRECLASSIFIER_ENABLED', 'false').lower() == 'true'
+PRECLASSIFIER_MIN_HITS = int(os.environ.get('PRECLASSIFIER_MIN_HITS', 2))  # lexicon words needed to answer locally
+PRECLASSIFIER_SENTIMENT_THRESHOLD = float(os.environ.get('PRECLASSIFIER_SENTIMENT_THRESHOLD', 0.6))
+PRECLASSIFIER_CATEGORY_THRESHOLD = float(os.environ.get('PRECLASSIFIER_CATEGORY_THRESHOLD', 0.6))
+
+CHUNK_MAX_TOKENS = int(os.environ.get('CHUNK_MAX_TOKENS', 1500))  # longer texts are split and analyzed per chunk
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 100))
+CHUNK_TOP_CATEGORIES = int(os.environ.get('CHUNK_TOP_CATEGORIES', 3))
+
+WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', 9100))  # 0 disables the worker /metrics server
+
+# JSON list of backends, e.g. [{"name": "gpu1", "type": "ollama", "url": "...", "models": ["llama3.1"]},
+# {"name": "azure", "type": "azure", "deployment": "gpt-4o-mini"}]. Defaults to OLLAMA_URL alone.
+LLM_BACKENDS = os.environ.get('LLM_BACKENDS')
+LLM_MAX_ATTEMPTS = int(os.environ.get('LLM_MAX_ATTEMPTS', 2))  # backends tried before a request fails
+LLM_HEDGE_DELAY = float(os.environ.get('LLM_HEDGE_DELAY', 0))  # seconds before a hedged request is sent, 0 disables
+LLM_HEALTH_INTERVAL = float(os.environ.get('LLM_HEALTH_INTERVAL', 15))  # seconds, 0 disables health checks
+LLM_CIRCUIT_FAILURES = int(os.environ.get('LLM_CIRCUIT_FAILURES', 5))
+LLM_CIRCUIT_COOLDOWN = float(os.environ.get('LLM_CIRCUIT_COOLDOWN', 30))  # seconds
+
+# Admission control, per process: LLM requests in flight, shared by the lanes in priority order
+# (interactive API calls, API batches, background queue work). 0 disables it.
+LLM_ADMISSION_CAPACITY = int(os.environ.get('LLM_ADMISSION_CAPACITY', 16))
+LLM_BATCH_LANE_LIMIT = int(os.environ.get('LLM_BATCH_LANE_LIMIT', 12))
+LLM_BACKGROUND_LANE_LIMIT = int(os.environ.get('LLM_BACKGROUND_LANE_LIMIT', 8))
+LLM_ADMISSION_QUEUE = int(os.environ.get('LLM_ADMISSION_QUEUE', 64))  # API requests waiting per lane before 429s
+LLM_ADMISSION_TIMEOUT = float(os.environ.get('LLM_ADMISSION_TIMEOUT', 5))  # seconds an API request waits for a slot
+# Background slots shared by all processes through the llm_admission_usage table, synced every
+# LLM_ADMISSION_SYNC_INTERVAL seconds (0 keeps every process on its own budget)
+LLM_CLUSTER_BACKGROUND_LIMIT = int(os.environ.get('LLM_CLUSTER_BACKGROUND_LIMIT', 16))
+LLM_ADMISSION_SYNC_INTERVAL = float(os.environ.get('LLM_ADMISSION_SYNC_INTERVAL', 1))
+
+ROLLUP_REFRESH_INTERVAL = float(os.environ.get('ROLLUP_REFRESH_INTERVAL', 30))  # seconds between rollup refreshes
+ROLLUP_REFRESH_OVERLAP = float(os.environ.get('ROLLUP_REFRESH_OVERLAP', 60))  # seconds re-checked before the watermark
+
+# Connection pools, per engine and process
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 20))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # seconds before a connection is replaced
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# Pools of each process started by rabbit.supervisor, which runs up to SUPERVISOR_MAX_WORKERS per queue;
+# raise them with SINGLEFLIGHT_ADVISORY_LOCK, which holds a connection per message being processed
+WORKER_DB_POOL_SIZE = int(os.environ.get('WORKER_DB_POOL_SIZE', 2))
+WORKER_DB_MAX_OVERFLOW = int(os.environ.get('WORKER_DB_MAX_OVERFLOW', 2))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 100))  # asyncpg prepared statements, 0 behind pgbouncer
+
+SINGLEFLIGHT_ENABLED = os.environ.get('SINGLEFLIGHT_ENABLED', 'true').lower() == 'true'  # coalesce identical in-flight work
+# Also coalesce across processes through Postgres advisory locks
+SINGLEFLIGHT_ADVISORY_LOCK = os.environ.get('SINGLEFLIGHT_ADVISORY_LOCK', 'false').lower() == 'true'
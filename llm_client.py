@@ -0,0 +1,532 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import aclosing
+
+import httpx
+from openai import AsyncAzureOpenAI, OpenAIError
+
+import admission
+from config import (
+    OLLAMA_URL, OLLAMA_MODEL, LLM_MAX_CONCURRENCY, LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT,
+    LLM_POOL_TIMEOUT, LLM_MAX_CONNECTIONS, LLM_MAX_KEEPALIVE_CONNECTIONS, LLM_KEEPALIVE_EXPIRY,
+    LLM_BACKENDS, LLM_MAX_ATTEMPTS, LLM_HEDGE_DELAY, LLM_HEALTH_INTERVAL, LLM_CIRCUIT_FAILURES,
+    LLM_CIRCUIT_COOLDOWN, LLM_KEEP_ALIVE, LLM_WARMUP, LLM_WARMUP_TIMEOUT,
+)
+from metrics import LLM_LATENCY
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    """Raised when the LLM backend is unreachable or returns an error."""
+
+
+class UnknownModelError(LLMError):
+    """Raised when no configured backend serves the requested model."""
+
+
+class GenerationProfile:
+    """
+    Decoding settings for one kind of request: the token budget, stop sequences, temperature,
+    output format ("json" or a JSON schema) and how long Ollama keeps the model loaded afterwards.
+    None leaves a setting to the backend's default.
+    """
+
+    def __init__(self, max_tokens=None, stop=(), temperature=None, format=None, keep_alive=LLM_KEEP_ALIVE):
+        self.max_tokens = max_tokens
+        self.stop = tuple(stop)
+        self.temperature = temperature
+        self.format = format
+        self.keep_alive = keep_alive
+
+    def replace(self, **changes) -> "GenerationProfile":
+        return GenerationProfile(**{**vars(self), **changes})
+
+    def output_settings(self) -> str:
+        """The settings that affect the output (all but keep_alive), as a stable string."""
+        settings = {key: value for key, value in vars(self).items() if key != "keep_alive"}
+        return json.dumps(settings, sort_keys=True, default=list)
+
+    def ollama_payload(self) -> dict:
+        """The profile as fields of an Ollama generate request."""
+        options = {}
+        if self.max_tokens is not None:
+            options["num_predict"] = self.max_tokens
+        if self.stop:
+            options["stop"] = list(self.stop)
+        if self.temperature is not None:
+            options["temperature"] = self.temperature
+        payload = {"options": options} if options else {}
+        if self.format:
+            payload["format"] = self.format
+        if self.keep_alive:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+
+DEFAULT_PROFILE = GenerationProfile()
+
+
+def _http_client():
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT, pool=LLM_POOL_TIMEOUT
+        ),
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+class Backend:
+    """
+    Base class for an LLM endpoint. Tracks in-flight requests for load balancing,
+    the health check result and a circuit breaker that takes the backend out of
+    rotation for LLM_CIRCUIT_COOLDOWN seconds after LLM_CIRCUIT_FAILURES consecutive failures.
+    """
+    type = None
+
+    def __init__(self, name, models, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.name = name
+        self.models = set(models)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.open_until = 0.0
+
+    def serves(self, model: str) -> bool:
+        return model in self.models or model == self.type
+
+    def model_for(self, model: str) -> str:
+        """The model name to send to this backend for a requested model or backend type."""
+        return next(iter(self.models)) if model == self.type else model
+
+    def available(self) -> bool:
+        return self.healthy and self.open_until <= time.monotonic()
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= LLM_CIRCUIT_FAILURES:
+            if self.open_until <= time.monotonic():
+                logger.warning(f"LLM backend {self.name} failed {self.failures} times in a row, opening circuit")
+            self.open_until = time.monotonic() + LLM_CIRCUIT_COOLDOWN
+
+    async def check_health(self) -> bool:
+        return True
+
+    async def warm_up(self, model: str):
+        """Load the model so the first request doesn't wait for it."""
+
+    async def aclose(self):
+        pass
+
+
+class OllamaBackend(Backend):
+    """
+    Async client for the Ollama generate API.
+    Keeps a pool of keep-alive connections and limits the number of
+    requests that are in flight against the backend at the same time.
+    """
+    type = "ollama"
+
+    def __init__(self, name, url, models=(OLLAMA_MODEL,), max_concurrency=LLM_MAX_CONCURRENCY, health_url=None):
+        super().__init__(name, models, max_concurrency)
+        self.url = url
+        self.health_url = health_url or url.rsplit("/api/", 1)[0] + "/api/tags"
+        self._http = _http_client()
+
+    async def generate(self, prompt: str, model: str, profile: GenerationProfile = DEFAULT_PROFILE) -> str:
+        """
+        Sends a prompt to the Ollama server and returns the stripped response text,
+        generated with the budget, stop sequences and format of the profile.
+        """
+        payload = {"model": model, "prompt": prompt, "stream": False, **profile.ollama_payload()}
+        async with self._semaphore:
+            try:
+                with LLM_LATENCY.time(mode="generate"):
+                    response = await self._http.post(self.url, json=payload)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                raise LLMError(f"Ollama server error ({self.name}): {e}") from e
+        return response.json().get("response", "").strip()
+
+    async def stream(self, prompt: str, model: str, profile: GenerationProfile = DEFAULT_PROFILE):
+        """
+        Sends a prompt with stream=true and yields response tokens as they arrive.
+        Closing the generator early closes the connection, which stops the generation.
+        """
+        payload = {"model": model, "prompt": prompt, "stream": True, **profile.ollama_payload()}
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                async with self._http.stream("POST", self.url, json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("response"):
+                            yield chunk["response"]
+                        if chunk.get("done"):
+                            return
+            except httpx.HTTPError as e:
+                raise LLMError(f"Ollama server error ({self.name}): {e}") from e
+            finally:
+                LLM_LATENCY.observe(time.perf_counter() - start, mode="stream")
+
+    async def check_health(self) -> bool:
+        try:
+            response = await self._http.get(self.health_url, timeout=LLM_CONNECT_TIMEOUT)
+            return response.status_code < 500
+        except httpx.HTTPError:
+            return False
+
+    async def warm_up(self, model: str):
+        """A request without a prompt loads the model and keeps it loaded for LLM_KEEP_ALIVE."""
+        payload = {"model": model, "stream": False}
+        if LLM_KEEP_ALIVE:
+            payload["keep_alive"] = LLM_KEEP_ALIVE
+        try:
+            response = await self._http.post(self.url, json=payload)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise LLMError(f"Ollama server error ({self.name}): {e}") from e
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+class AzureBackend(Backend):
+    """Azure OpenAI chat deployment, used through the official async client."""
+    type = "azure"
+
+    def __init__(self, name, endpoint, deployment, api_key, api_version="2024-02-01",
+                 max_concurrency=LLM_MAX_CONCURRENCY):
+        super().__init__(name, [deployment], max_concurrency)
+        self._client = AsyncAzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            max_retries=0,  # retries and failover are handled by the router
+            http_client=_http_client(),
+        )
+
+    def _request(self, prompt, model, profile, stream):
+        request = {"model": model, "messages": [{"role": "user", "content": prompt}], "stream": stream}
+        if profile.max_tokens is not None:
+            request["max_tokens"] = profile.max_tokens
+        if profile.stop:
+            request["stop"] = list(profile.stop[:4])  # the API takes up to four
+        if profile.temperature is not None:
+            request["temperature"] = profile.temperature
+        # JSON mode only produces objects, so a schema for anything else is left to the prompt.
+        if profile.format == "json" or isinstance(profile.format, dict) and profile.format.get("type") == "object":
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    async def generate(self, prompt: str, model: str, profile: GenerationProfile = DEFAULT_PROFILE) -> str:
+        async with self._semaphore:
+            try:
+                with LLM_LATENCY.time(mode="generate"):
+                    response = await self._client.chat.completions.create(
+                        **self._request(prompt, model, profile, stream=False)
+                    )
+            except OpenAIError as e:
+                raise LLMError(f"Azure OpenAI error ({self.name}): {e}") from e
+        return (response.choices[0].message.content or "").strip()
+
+    async def stream(self, prompt: str, model: str, profile: GenerationProfile = DEFAULT_PROFILE):
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                response = await self._client.chat.completions.create(
+                    **self._request(prompt, model, profile, stream=True)
+                )
+                async with response:
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+            except OpenAIError as e:
+                raise LLMError(f"Azure OpenAI error ({self.name}): {e}") from e
+            finally:
+                LLM_LATENCY.observe(time.perf_counter() - start, mode="stream")
+
+    async def aclose(self):
+        await self._client.close()
+
+
+def create_backend(spec: dict) -> Backend:
+    """
+    Build a backend from one LLM_BACKENDS entry, e.g.
+    {"name": "gpu1", "type": "ollama", "url": "http://gpu1:11434/api/generate", "models": ["llama3.1"]} or
+    {"name": "azure", "type": "azure", "endpoint": "...", "deployment": "gpt-4o-mini"}.
+    {"type": "stub", "latency": 0.05} answers locally without a model, see stub_llm.py.
+    Azure credentials default to the AZURE_OPENAI_* environment variables.
+    """
+    spec = dict(spec)
+    backend_type = spec.pop("type", "ollama")
+    if backend_type == "ollama":
+        return OllamaBackend(**spec)
+    if backend_type == "azure":
+        spec.setdefault("endpoint", os.getenv("AZURE_OPENAI_ENDPOINT"))
+        spec.setdefault("deployment", os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"))
+        spec.setdefault("api_key", os.getenv("AZURE_OPENAI_API_KEY"))
+        spec.setdefault("api_version", os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"))
+        return AzureBackend(**spec)
+    if backend_type == "stub":
+        from stub_llm import StubBackend  # stub_llm builds on this module
+        return StubBackend(**spec)
+    raise ValueError(f"Unknown LLM backend type: {backend_type}")
+
+
+def resolve_model(model: str = None) -> str:
+    """Canonical name of a requested model: None and 'llama' mean the default Ollama model."""
+    return OLLAMA_MODEL if model in (None, "", "llama") else model
+
+
+class LLMRouter:
+    """
+    Routes requests over a pool of backends.
+    A request goes to the available backend serving the model with the fewest requests
+    in flight. If it fails, the next backend is tried, up to LLM_MAX_ATTEMPTS backends.
+    With LLM_HEDGE_DELAY set, a request that hasn't finished after that many seconds is
+    also sent to a second backend and the first answer wins.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self._health_task = None
+
+    def start_health_checks(self):
+        if self._health_task is None and LLM_HEALTH_INTERVAL > 0:
+            self._health_task = asyncio.get_running_loop().create_task(self._check_health())
+
+    async def _check_health(self):
+        while True:
+            for backend, healthy in zip(
+                self.backends, await asyncio.gather(*(backend.check_health() for backend in self.backends))
+            ):
+                if healthy != backend.healthy:
+                    logger.warning(f"LLM backend {backend.name} is {'healthy' if healthy else 'unhealthy'}")
+                backend.healthy = healthy
+            await asyncio.sleep(LLM_HEALTH_INTERVAL)
+
+    def candidates(self, model: str):
+        """Backends serving the model, preferring those that are healthy and not tripped."""
+        serving = [backend for backend in self.backends if backend.serves(model)]
+        if not serving:
+            raise UnknownModelError(f"No LLM backend serves model '{model}'")
+        # When every backend is out of rotation, trying one beats failing outright.
+        return [backend for backend in serving if backend.available()] or serving
+
+    @staticmethod
+    def _pick(candidates, exclude):
+        remaining = [backend for backend in candidates if backend not in exclude]
+        return min(remaining, key=lambda backend: backend.outstanding, default=None)
+
+    async def _call(self, backend, prompt, model, profile):
+        backend.outstanding += 1
+        try:
+            result = await backend.generate(prompt, backend.model_for(model), profile=profile)
+        except LLMError:
+            backend.record_failure()
+            raise
+        finally:
+            backend.outstanding -= 1
+        backend.record_success()
+        return result
+
+    async def _hedged(self, backend, candidates, tried, prompt, model, profile):
+        tasks = {asyncio.ensure_future(self._call(backend, prompt, model, profile))}
+        try:
+            if LLM_HEDGE_DELAY > 0:
+                done, _ = await asyncio.wait(tasks, timeout=LLM_HEDGE_DELAY)
+                hedge = None if done else self._pick(candidates, tried)
+                if hedge is not None:
+                    tried.add(hedge)
+                    tasks.add(asyncio.ensure_future(self._call(hedge, prompt, model, profile)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def generate(self, prompt: str, model: str = None, profile: GenerationProfile = DEFAULT_PROFILE) -> str:
+        model = resolve_model(model)
+        candidates = self.candidates(model)
+        tried = set()
+        error = None
+        for _ in range(LLM_MAX_ATTEMPTS):
+            backend = self._pick(candidates, tried)
+            if backend is None:
+                break
+            tried.add(backend)
+            try:
+                return await self._hedged(backend, candidates, tried, prompt, model, profile)
+            except LLMError as e:
+                logger.warning(str(e))
+                error = e
+        raise error
+
+    async def stream(self, prompt: str, model: str = None, profile: GenerationProfile = DEFAULT_PROFILE):
+        """Streams from the least loaded backend; fails over only until the first token is out."""
+        model = resolve_model(model)
+        candidates = self.candidates(model)
+        tried = set()
+        error = None
+        for _ in range(LLM_MAX_ATTEMPTS):
+            backend = self._pick(candidates, tried)
+            if backend is None:
+                break
+            tried.add(backend)
+            started = False
+            backend.outstanding += 1
+            try:
+                async with aclosing(backend.stream(prompt, backend.model_for(model), profile=profile)) as tokens:
+                    async for token in tokens:
+                        started = True
+                        yield token
+                backend.record_success()
+                return
+            except LLMError as e:
+                backend.record_failure()
+                if started:
+                    raise
+                logger.warning(str(e))
+                error = e
+            finally:
+                backend.outstanding -= 1
+        raise error
+
+    async def warm_up(self, model: str = None):
+        """Load the model on every backend serving it; a backend that fails is logged and skipped."""
+        model = resolve_model(model)
+        backends = [backend for backend in self.backends if backend.serves(model)]
+        results = await asyncio.gather(
+            *(backend.warm_up(backend.model_for(model)) for backend in backends), return_exceptions=True
+        )
+        for backend, result in zip(backends, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Could not warm up {model} on LLM backend {backend.name}: {result}")
+
+    async def aclose(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for backend in self.backends:
+            await backend.aclose()
+
+
+_backend_override = None
+
+
+def use_backends(specs):
+    """Replace the LLM_BACKENDS configuration for the routers created from now on."""
+    global _backend_override
+    _backend_override = specs
+
+
+def _backend_specs():
+    if _backend_override is not None:
+        return _backend_override
+    if LLM_BACKENDS:
+        return json.loads(LLM_BACKENDS)
+    return [{"name": "ollama", "type": "ollama", "url": OLLAMA_URL, "models": [OLLAMA_MODEL]}]
+
+
+# httpx connections are bound to the event loop that opened them,
+# so every running loop gets its own router and backend clients.
+_routers = {}
+
+
+def get_router() -> LLMRouter:
+    """Return the LLM router for the currently running event loop."""
+    loop = asyncio.get_running_loop()
+    router = _routers.get(loop)
+    if router is None:
+        router = _routers[loop] = LLMRouter([create_backend(spec) for spec in _backend_specs()])
+        router.start_health_checks()
+    return router
+
+
+async def close_client():
+    """Close the LLM router of the currently running event loop, if any."""
+    router = _routers.pop(asyncio.get_running_loop(), None)
+    if router is not None:
+        await router.aclose()
+
+
+async def warm_up(model: str = None):
+    """
+    Load the model on its backends before the first request, waiting at most LLM_WARMUP_TIMEOUT
+    seconds; a no-op when LLM_WARMUP is off. A model that doesn't load in time is loaded by the
+    first request instead.
+    """
+    if not LLM_WARMUP:
+        return
+    model = resolve_model(model)
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(get_router().warm_up(model), LLM_WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Warming up {model} took longer than {LLM_WARMUP_TIMEOUT}s, not waiting for it")
+        return
+    logger.info(f"Warmed up {model} in {time.perf_counter() - start:.1f}s")
+
+
+async def query_llm(prompt: str, model: str = None, profile: GenerationProfile = DEFAULT_PROFILE) -> str:
+    """
+    Sends a prompt to a backend serving the model through the shared pooled clients,
+    once admission control grants a slot in the caller's lane.
+    """
+    async with admission.slot():
+        return await get_router().generate(prompt, model=model, profile=profile)
+
+
+async def stream_llm(prompt: str, model: str = None, profile: GenerationProfile = DEFAULT_PROFILE):
+    """
+    Streams the response tokens for a prompt through the shared pooled clients.
+    The admission slot is held until the stream is closed.
+    """
+    async with admission.slot():
+        async with aclosing(get_router().stream(prompt, model=model, profile=profile)) as tokens:
+            async for token in tokens:
+                yield token
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-client-loop", daemon=True).start()
+    return _loop
+
+
+def run_sync(coro):
+    """
+    Run a coroutine on the shared background event loop and wait for its result.
+    Lets synchronous code (e.g. pika callbacks) reuse the pooled async client.
+    Its LLM requests use the background lane.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_background_loop()).result()
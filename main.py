@@ -1,158 +1,363 @@
-import os
-import requests
-from fastapi import FastAPI, HTTPException
+import asyncio
+import functools
+import json
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime
+from typing import Literal, Optional
+
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # Import database engine and models
-from db import engine, SessionLocal
-from orm_models import Base, QueryResult
-from models import QueryRequest, QueryResponse  # Assumes QueryRequest includes fields: ucid, text, service
+from db import engine, async_engine, get_db
+from orm_models import Base
+from models import (  # Assumes QueryRequest includes fields: ucid, text, service
+    QueryRequest, QueryResponse, BatchQueryRequest, BatchQueryResponse, BatchItemResult,
+    AnalyzeBatchResponse, AnalyzeItemResult, AnalyticsSummary, AnalyticsTimeseries, StoredResultPage,
+)
+import admission
+import analytics
+import analysis
+import llm_client
+from cache import result_cache
+from config import BATCH_MAX_ITEMS, LLM_BATCH_LANE_LIMIT
+import metrics
+from migrations import run_migrations
+from parsing import TYPED_COLUMNS, CATEGORIES
+from persistence import save_query_results_async, write_buffer
+import rollup
 
 # Load environment variables from .env
 load_dotenv()
 
-# Initialize the Azure OpenAI client
-#client = AzureOpenAI(
-#    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-#    api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
-#    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-#)
-
-#eployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "REPLACE_WITH_YOUR_DEPLOYMENT_NAME")
-ollama_url = "http://40.113.50.250:8080/llama/api/generate"  # Ollama local API
 # Create database tables if they do not exist yet
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
 
-app = FastAPI()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await llm_client.warm_up()
+    refresher = asyncio.create_task(rollup.refresh_periodically(engine))
+    yield
+    refresher.cancel()
+    await llm_client.close_client()
+    await async_engine.dispose()
 
-def get_or_create_query_result(db, query: QueryRequest):
-    """
-    If a record with the given ucid and service already exists, return it.
-    Otherwise, create a new record with the provided ucid, text, and service.
-    """
-    record = db.query(QueryResult).filter(
-        QueryResult.ucid == query.ucid,
-        QueryResult.service == query.service
-    ).first()
-    if not record:
-        record = QueryResult(ucid=query.ucid, text=query.text, service=query.service)
-        db.add(record)
-    return record
 
+app = FastAPI(lifespan=lifespan)
 
 
+@app.middleware("http")
+async def interactive_lane(request: Request, call_next):
+    """LLM requests made for API calls take priority over background queue work."""
+    with admission.lane("interactive"):
+        return await call_next(request)
 
 
-#def query_azure(prompt: str) -> str:
-#    """
-#    Sends a prompt to Azure OpenAI and returns the result.
-#    """
-#    try:
-#        response = client.completions.create(
-#            model=deployment_name,
-#            prompt=prompt,
-#            max_tokens=100,
-#            temperature=0.7
-#        )
-#        return response.choices[0].text.strip()
-#    except Exception as e:
-#        raise HTTPException(status_code=500, detail=f"Azure OpenAI error: {e}")
+@app.exception_handler(admission.OverloadedError)
+async def overloaded_handler(request: Request, exc: admission.OverloadedError):
+    return JSONResponse(
+        status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)}
+    )
 
 
-def query_ollama(prompt: str) -> str:
+async def save_query_result(query: QueryRequest, **fields):
     """
-    Sends a prompt to the local Ollama server and returns the result.
+    Stores the analysis fields for the query through the shared write buffer
+    and waits until they are committed.
     """
+    row = {"ucid": query.ucid, "service": query.service, "text": query.text, **fields}
+    try:
+        await asyncio.wrap_future(write_buffer.add(row))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database save error: {e}")
+
+
+def check_model(model):
+    """Rejects a 'model' parameter that no configured LLM backend serves."""
     try:
-        response = requests.post(ollama_url, json={"model": "llama3.1", "prompt": prompt, "stream": False})
-        response.raise_for_status()
-        return response.json().get("response", "").strip()
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Ollama server error: {e}")
+        llm_client.get_router().candidates(llm_client.resolve_model(model))
+    except llm_client.UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def run_analysis(analysis_call):
+    """
+    Awaits an analysis call, which is routed to one of the configured LLM backends unless
+    the result for the same text is already cached or answered locally, and returns the result.
+    """
+    try:
+        return await analysis_call
+    except llm_client.UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except llm_client.LLMError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/sentiment", response_model=QueryResponse)
-def sentiment_endpoint(query: QueryRequest, model: str = "azure"):
+async def sentiment_endpoint(query: QueryRequest, model: Optional[str] = None):
     """
     Performs sentiment analysis on the text.
-    If the 'model' parameter is set to "llama", the local Ollama server is used,
-    otherwise Azure OpenAI is used.
+    The 'model' parameter selects the model: a model name served by one of the configured
+    backends, "llama" for the default Ollama model or "azure" for an Azure OpenAI deployment.
     """
     # Check if the text is empty or contains only whitespace
     if not query.text or not query.text.strip():
         raise HTTPException(status_code=400, detail="Input text is empty or whitespace.")
 
-    prompt = (
-        "Please determine the emotional tone of the text (positive, negative, or neutral). "
-        "Answer strictly with a single number without any explanations:\n"
-        "-1 for negative\n"
-        "0 for neutral\n"
-        "1 for positive\n\n"
-        f"Text:\n{query.text}\n\n"
-        "Answer:"
-    )
-
-    result_text = query_ollama(prompt)  # if model == "llama" else query_azure(prompt)
+    fields = await run_analysis(analysis.classify_sentiment(query.text, model))
 
-    db = SessionLocal()
-    try:
-        record = get_or_create_query_result(db, query)
-        record.sentiment = result_text
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Database save error: {e}")
-    finally:
-        db.close()
+    await save_query_result(query, **fields)
 
-    return QueryResponse(ucid=query.ucid, result=result_text)
+    return QueryResponse(ucid=query.ucid, result=fields["sentiment"], tier=fields["sentiment_tier"], value=fields["sentiment_value"])
 
 
 @app.post("/categories", response_model=QueryResponse)
-def categories_endpoint(query: QueryRequest, model: str = "azure"):
+async def categories_endpoint(query: QueryRequest, model: Optional[str] = None):
     """
     Performs category classification on the text.
-    If the 'model' parameter is set to "llama", the local Ollama server is used,
-    otherwise Azure OpenAI is used.
+    The 'model' parameter selects the model, as for /sentiment.
     """
     # Check if the text is empty or contains only whitespace
     if not query.text or not query.text.strip():
         raise HTTPException(status_code=400, detail="Input text is empty or whitespace.")
 
-    prompt = (
-        "Identify which of the following possible categories best fits this text:\n\n"
-        "1) Politics\n"
-        "2) Technology\n"
-        "3) Entertainment\n"
-        "4) Sports\n"
-        "5) Science\n"
-        "6) Health\n"
-        "7) Ecology\n"
-        "8) Finance\n"
-        "9) Cars\n"
-        "10) Other\n\n"
-        "You can select multiple categories (up to three) if it is really justified. "
-        "If you are unsure, select 'Other'.\n\n"
-        "Return the result strictly in JSON array format (for example: [\"Technology\"] or [\"Sports\",\"Health\"]). "
-        "Do not add any additional text.\n\n"
-        f"Text:\n{query.text}\n\n"
-        "Answer:"
-    )
+    fields = await run_analysis(analysis.classify_category(query.text, model))
+
+    await save_query_result(query, **fields)
+
+    return QueryResponse(ucid=query.ucid, result=fields["category"], tier=fields["category_tier"], value=fields["category_mask"])
+
+
+async def analyze_batch_items(items, analyze):
+    """
+    Runs analyze(text) concurrently for every item and returns a list with a result
+    or an error message per item. Results for cached texts don't reach the LLM.
+    The LLM requests use the batch lane. The request is admitted as a whole, or rejected
+    with 429 before any item runs; at most LLM_BATCH_LANE_LIMIT items are analyzed at once
+    and the rest wait their turn.
+    """
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch is limited to {BATCH_MAX_ITEMS} items.")
+    semaphore = asyncio.Semaphore(max(1, LLM_BATCH_LANE_LIMIT))
+
+    async def run(item):
+        if not item.text or not item.text.strip():
+            raise ValueError("Input text is empty or whitespace.")
+        async with semaphore:
+            return await analyze(item.text)
+
+    with admission.admitted("batch"):
+        outcomes = await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+    return [
+        (None, str(outcome)) if isinstance(outcome, Exception) else (outcome, None)
+        for outcome in outcomes
+    ]
 
-    result_text = query_ollama(prompt)  # if model == "llama" else query_azure(prompt)
 
-    db = SessionLocal()
+async def save_batch(db: AsyncSession, rows):
+    """Writes all successful batch results with one bulk upsert."""
+    if not rows:
+        return
     try:
-        record = get_or_create_query_result(db, query)
-        record.category = result_text
-        db.commit()
+        await save_query_results_async(db, rows)
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Database save error: {e}")
-    finally:
-        db.close()
 
-    return QueryResponse(ucid=query.ucid, result=result_text)
 
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_response(query: QueryRequest, task: str, model: str = None) -> StreamingResponse:
+    """
+    Streams the analysis of the query as server-sent events: a 'token' event per
+    generated token, then a 'result' event once the answer is stored (or an 'error' event).
+    The first event is produced before the response starts, so a request that admission
+    control turns away gets a 429 with Retry-After instead of a stream with an 'error' event.
+    """
+    if not query.text or not query.text.strip():
+        raise HTTPException(status_code=400, detail="Input text is empty or whitespace.")
+    check_model(model)
+
+    analysis_events = analysis.stream_analysis(task, query.text, model)
+    try:
+        first = await anext(analysis_events)
+    except llm_client.LLMError as e:
+        await analysis_events.aclose()
+        raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        await analysis_events.aclose()
+        raise
+
+    async def event(kind, value) -> str:
+        if kind == "token":
+            return sse_event("token", value)
+        await save_query_result(query, **value)
+        return sse_event("result", {
+            "ucid": query.ucid, "result": value[task], "tier": value[f"{task}_tier"],
+            "value": value[TYPED_COLUMNS[task]],
+        })
+
+    async def events():
+        async with aclosing(analysis_events):
+            try:
+                yield await event(*first)
+                async for kind, value in analysis_events:
+                    yield await event(kind, value)
+            except (llm_client.LLMError, admission.OverloadedError) as e:
+                yield sse_event("error", str(e))
+            except HTTPException as e:
+                yield sse_event("error", e.detail)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/sentiment/stream")
+async def sentiment_stream_endpoint(query: QueryRequest, model: Optional[str] = None):
+    """
+    Streaming variant of /sentiment. Stops generating as soon as a valid answer is parsed.
+    """
+    return await stream_response(query, "sentiment", model)
+
+
+@app.post("/categories/stream")
+async def categories_stream_endpoint(query: QueryRequest, model: Optional[str] = None):
+    """
+    Streaming variant of /categories. Stops generating as soon as a valid answer is parsed.
+    """
+    return await stream_response(query, "category", model)
+
+
+@app.post("/sentiment/batch", response_model=BatchQueryResponse)
+async def sentiment_batch_endpoint(
+    batch: BatchQueryRequest, model: Optional[str] = None, db: AsyncSession = Depends(get_db)
+):
+    """
+    Performs sentiment analysis on a list of texts.
+    Items that fail are reported with an error and are not stored.
+    """
+    check_model(model)
+    outcomes = await analyze_batch_items(batch.items, functools.partial(analysis.classify_sentiment, model=model))
+    await save_batch(db, [
+        {"ucid": item.ucid, "service": item.service, "text": item.text, **fields}
+        for item, (fields, error) in zip(batch.items, outcomes) if error is None
+    ])
+    return BatchQueryResponse(results=[
+        BatchItemResult(
+            ucid=item.ucid, service=item.service, error=error,
+            result=fields["sentiment"] if fields else None, tier=fields["sentiment_tier"] if fields else None,
+            value=fields["sentiment_value"] if fields else None,
+        )
+        for item, (fields, error) in zip(batch.items, outcomes)
+    ])
+
+
+@app.post("/categories/batch", response_model=BatchQueryResponse)
+async def categories_batch_endpoint(
+    batch: BatchQueryRequest, model: Optional[str] = None, db: AsyncSession = Depends(get_db)
+):
+    """
+    Performs category classification on a list of texts.
+    Items that fail are reported with an error and are not stored.
+    """
+    check_model(model)
+    outcomes = await analyze_batch_items(batch.items, functools.partial(analysis.classify_category, model=model))
+    await save_batch(db, [
+        {"ucid": item.ucid, "service": item.service, "text": item.text, **fields}
+        for item, (fields, error) in zip(batch.items, outcomes) if error is None
+    ])
+    return BatchQueryResponse(results=[
+        BatchItemResult(
+            ucid=item.ucid, service=item.service, error=error,
+            result=fields["category"] if fields else None, tier=fields["category_tier"] if fields else None,
+            value=fields["category_mask"] if fields else None,
+        )
+        for item, (fields, error) in zip(batch.items, outcomes)
+    ])
+
+
+@app.post("/analyze/batch", response_model=AnalyzeBatchResponse)
+async def analyze_batch_endpoint(
+    batch: BatchQueryRequest, model: Optional[str] = None, db: AsyncSession = Depends(get_db)
+):
+    """
+    Performs sentiment analysis and category classification on a list of texts.
+    Items that fail are reported with an error and are not stored.
+    """
+    check_model(model)
+    outcomes = await analyze_batch_items(batch.items, functools.partial(analysis.classify_text, model=model))
+    await save_batch(db, [
+        {"ucid": item.ucid, "service": item.service, "text": item.text, **fields}
+        for item, (fields, error) in zip(batch.items, outcomes) if error is None
+    ])
+    return AnalyzeBatchResponse(results=[
+        AnalyzeItemResult(ucid=item.ucid, service=item.service, error=error, **(fields or {}))
+        for item, (fields, error) in zip(batch.items, outcomes)
+    ])
+
+
+@app.get("/analytics/summary", response_model=AnalyticsSummary)
+async def analytics_summary(
+    service: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Sentiment and category distributions of the stored results, optionally for one service
+    and a ts range. Served from the hourly rollup table, so the range is applied to whole hours
+    and results stored in the last ROLLUP_REFRESH_INTERVAL seconds may not be counted yet.
+    """
+    return await analytics.summarize(db, service, start, end)
+
+
+@app.get("/analytics/timeseries", response_model=AnalyticsTimeseries)
+async def analytics_timeseries(
+    interval: Literal[analytics.INTERVALS] = "day",
+    service: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Distributions per hour, day, week or month, oldest first."""
+    return AnalyticsTimeseries(buckets=await analytics.timeseries(db, interval, service, start, end))
+
+
+@app.get("/analytics/results", response_model=StoredResultPage)
+async def analytics_results(
+    service: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    category: Optional[Literal[CATEGORIES]] = None,
+    sentiment: Optional[int] = Query(None, ge=-1, le=1),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Stored results, newest first. Pass next_cursor from the response as 'cursor'
+    to fetch the next page; it is null after the last page.
+    """
+    try:
+        items, next_cursor = await analytics.list_results(
+            db, service, start, end, category, sentiment, limit, cursor
+        )
+    except analytics.InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StoredResultPage(items=items, next_cursor=next_cursor)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Returns hit and miss counters of the result cache."""
+    return result_cache.stats()
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus metrics of the API process."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
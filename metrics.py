@@ -0,0 +1,174 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with optional labels, rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Value that can go up and down, with optional labels, rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram with cumulative buckets and optional labels, rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(tuple(str(labels[name]) for name in self.labelnames), ((), 0.0))
+        return sum(counts)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [f'le="{bound}"'])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """All metrics of this process in the Prometheus text exposition format."""
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+LLM_LATENCY = Histogram("llm_request_seconds", "Duration of LLM backend requests.", ["mode"])
+LLM_ADMISSIONS = Counter("llm_admissions_total", "LLM requests by lane and admission outcome.", ["lane", "outcome"])
+LLM_ADMISSION_WAIT = Histogram("llm_admission_wait_seconds", "Time LLM requests waited for a slot.", ["lane"])
+DB_COMMIT_LATENCY = Histogram("db_commit_seconds", "Duration of bulk query result upserts including commit.")
+DB_ROWS_WRITTEN = Counter("db_rows_written_total", "Query result rows committed by bulk upserts.")
+# Only messages whose publisher set the AMQP timestamp (whole seconds) are counted.
+QUEUE_WAIT = Histogram(
+    "message_queue_wait_seconds", "Time from publishing a message to the start of its processing.", ["queue"]
+)
+WORKER_WAIT = Histogram(
+    "message_worker_wait_seconds", "Time a delivered message waited for a worker thread.", ["queue"]
+)
+MESSAGE_LATENCY = Histogram("message_seconds", "End-to-end processing time of a consumed message.", ["queue"])
+STAGE_LATENCY = Histogram("stage_seconds", "Duration of individual processing stages.", ["stage"])
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Result cache lookups by outcome.", ["result"])
+PARSE_FAILURES = Counter("llm_parse_failures_total", "LLM outputs that did not match the expected format.", ["task"])
+MESSAGES = Counter("messages_total", "Consumed messages by queue and outcome.", ["queue", "status"])
+SUPERVISOR_WORKERS = Gauge("supervisor_workers", "Worker processes consuming each queue.", ["queue"])
+SUPERVISOR_QUEUE_DEPTH = Gauge("supervisor_queue_depth", "Ready messages at the last queue depth check.", ["queue"])
+COALESCED = Counter("singleflight_coalesced_total", "Calls that joined an identical call already in flight.", ["scope"])
+
+
+def timed(stage: str):
+    """Context manager recording the duration of a processing stage."""
+    return STAGE_LATENCY.time(stage=stage)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int):
+    """Serve /metrics from a background thread, for processes without the FastAPI app."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
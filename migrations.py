@@ -0,0 +1,29 @@
+from sqlalchemy import text
+
+# create_all() only creates missing tables, so columns and indexes added to existing
+# tables are applied here. Every statement must be idempotent: they run on every start.
+MIGRATIONS = [
+    "ALTER TABLE query_results ADD COLUMN IF NOT EXISTS sentiment_tier VARCHAR",
+    "ALTER TABLE query_results ADD COLUMN IF NOT EXISTS category_tier VARCHAR",
+    "ALTER TABLE query_results ADD COLUMN IF NOT EXISTS sentiment_value SMALLINT",
+    "ALTER TABLE query_results ADD COLUMN IF NOT EXISTS category_mask INTEGER",
+    "CREATE INDEX IF NOT EXISTS ix_query_results_sentiment_value ON query_results (sentiment_value)",
+    # A B-tree can't serve the category_mask & bit filters, so the index only cost writes
+    "DROP INDEX IF EXISTS ix_query_results_category_mask",
+    "CREATE INDEX IF NOT EXISTS ix_query_results_ts ON query_results (ts, ucid, service)",
+    "CREATE INDEX IF NOT EXISTS ix_query_results_service_ts ON query_results (service, ts, ucid)",
+    "ALTER TABLE query_results ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT timezone('utc', now())",
+    "CREATE INDEX IF NOT EXISTS ix_query_results_updated_at ON query_results (updated_at)",
+    # The rollup used to be maintained by row triggers; rollup.py refreshes it now.
+    "DROP TRIGGER IF EXISTS query_results_rollup_insert_delete ON query_results",
+    "DROP TRIGGER IF EXISTS query_results_rollup_update ON query_results",
+    "DROP FUNCTION IF EXISTS query_results_rollup_apply()",
+]
+
+
+def run_migrations(engine):
+    """Apply all migrations in one transaction, one process at a time."""
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('run_migrations'))"))
+        for statement in MIGRATIONS:
+            connection.execute(text(statement))
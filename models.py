@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, ConfigDict
 
 
 class QueryRequest(BaseModel):
@@ -10,3 +13,70 @@ class QueryRequest(BaseModel):
 class QueryResponse(BaseModel):
     ucid: str
     result: str
+    tier: Optional[str] = None
+    value: Optional[int] = None  # sentiment value or category bitmask
+
+
+class BatchQueryRequest(BaseModel):
+    items: List[QueryRequest]
+
+
+class BatchItemResult(BaseModel):
+    ucid: str
+    service: str
+    result: Optional[str] = None
+    tier: Optional[str] = None
+    value: Optional[int] = None
+    error: Optional[str] = None
+
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchItemResult]
+
+
+class AnalyzeItemResult(BaseModel):
+    ucid: str
+    service: str
+    sentiment: Optional[str] = None
+    category: Optional[str] = None
+    sentiment_tier: Optional[str] = None
+    category_tier: Optional[str] = None
+    sentiment_value: Optional[int] = None
+    category_mask: Optional[int] = None
+    error: Optional[str] = None
+
+
+class AnalyzeBatchResponse(BaseModel):
+    results: List[AnalyzeItemResult]
+
+
+class AnalyticsSummary(BaseModel):
+    total: int
+    sentiments: Dict[str, int]
+    categories: Dict[str, int]
+
+
+class AnalyticsBucket(AnalyticsSummary):
+    bucket: datetime
+
+
+class AnalyticsTimeseries(BaseModel):
+    buckets: List[AnalyticsBucket]
+
+
+class StoredResult(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    ucid: str
+    service: str
+    text: str
+    sentiment: Optional[str] = None
+    category: Optional[str] = None
+    sentiment_value: Optional[int] = None
+    category_mask: Optional[int] = None
+    ts: datetime
+
+
+class StoredResultPage(BaseModel):
+    items: List[StoredResult]
+    next_cursor: Optional[str] = None
@@ -0,0 +1,127 @@
+import functools
+import random
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+from config import NEAR_DUPLICATE_MAX_SIZE, NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_MIN_CHARS, NEAR_DUPLICATE_MAX_CHARS
+
+_word = re.compile(r"\w+")
+
+NGRAM_SIZE = 4
+BANDS, ROWS = 8, 4  # a text with Jaccard similarity 0.8 shares a band with ~98% probability
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20250101)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(BANDS * ROWS)]
+
+
+def fingerprint_text(text: str) -> str:
+    """Case, punctuation and spacing are ignored, as OCR gets them wrong most often."""
+    return " ".join(_word.findall(text.casefold()))
+
+
+def ngrams(text: str) -> set:
+    """Hashed character n-grams of a fingerprint_text() result."""
+    return {hash(text[i:i + NGRAM_SIZE]) & _PRIME for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+def minhash(features: set) -> tuple:
+    """MinHash signature of the feature set; the share of equal values estimates the Jaccard similarity."""
+    return tuple(min((a * x + b) % _PRIME for x in features) for a, b in _PERMUTATIONS)
+
+
+@functools.lru_cache(maxsize=4096)
+def signature_of(fingerprint: str) -> tuple:
+    """MinHash signature of a fingerprint; remembered, as a looked up text is usually added right after."""
+    return minhash(ngrams(fingerprint))
+
+
+def bands(signature: tuple) -> list:
+    return [signature[i:i + ROWS] for i in range(0, len(signature), ROWS)]
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class NearDuplicateIndex:
+    """
+    In-process index of analyzed texts for reusing the result of a near-duplicate, such as
+    OCR text of the same frame that differs by a few characters. Texts are compared as sets
+    of character n-grams: texts sharing a MinHash band are candidates, and a candidate is
+    a match when the Jaccard similarity of the n-gram sets reaches `threshold`.
+    Only candidates whose signatures estimate a similarity near the threshold are compared exactly.
+    Entries are kept per scope (task, prompt version, model); at most `maxsize` of them,
+    evicting the least recently used. Texts shorter than `min_chars` or longer than `max_chars`
+    are not indexed, which also bounds the cost of a signature. Lookups are CPU-bound, so
+    async callers run them in a thread.
+    """
+
+    def __init__(self, maxsize=NEAR_DUPLICATE_MAX_SIZE, threshold=NEAR_DUPLICATE_THRESHOLD,
+                 min_chars=NEAR_DUPLICATE_MIN_CHARS, max_chars=NEAR_DUPLICATE_MAX_CHARS):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._entries = OrderedDict()  # key -> (scope, fingerprint, signature, value)
+        self._buckets = defaultdict(set)  # (scope, band number, band) -> keys
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, text):
+        """The fingerprint of an indexable text, otherwise None."""
+        if len(text) > 2 * self.max_chars:
+            return None
+        fingerprint = fingerprint_text(text)
+        return fingerprint if self.min_chars <= len(fingerprint) <= self.max_chars else None
+
+    def find(self, scope, text):
+        """The value stored for the most similar indexed text of the scope, or None."""
+        fingerprint = self._fingerprint(text)
+        if fingerprint is None:
+            return None
+        features = ngrams(fingerprint)
+        signature = signature_of(fingerprint)
+        with self._lock:
+            candidates = set()
+            for i, band in enumerate(bands(signature)):
+                candidates |= self._buckets.get((scope, i, band), set())
+            best, best_similarity = None, self.threshold
+            for key in candidates:
+                _, other, other_signature, _ = self._entries[key]
+                estimate = sum(x == y for x, y in zip(signature, other_signature)) / len(signature)
+                if estimate < self.threshold - 0.2:
+                    continue
+                similarity = 1.0 if other == fingerprint else jaccard(features, ngrams(other))
+                if similarity >= best_similarity:
+                    best, best_similarity = key, similarity
+            if best is None:
+                return None
+            self._entries.move_to_end(best)
+            return self._entries[best][3]
+
+    def add(self, key, scope, text, value):
+        fingerprint = self._fingerprint(text)
+        if fingerprint is None:
+            return
+        signature = signature_of(fingerprint)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (scope, fingerprint, signature, value)
+            for i, band in enumerate(bands(signature)):
+                self._buckets[(scope, i, band)].add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        scope, _, signature, _ = entry
+        for i, band in enumerate(bands(signature)):
+            bucket = self._buckets[(scope, i, band)]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[(scope, i, band)]
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,4 +1,7 @@
-from sqlalchemy import Column, String, Text, DateTime, PrimaryKeyConstraint
+from sqlalchemy import (
+    Column, String, Text, DateTime, SmallInteger, Integer, BigInteger, PrimaryKeyConstraint, UniqueConstraint,
+    Index, Table, func,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -12,8 +15,65 @@ class QueryResult(Base):
     text = Column(Text, nullable=False)
     sentiment = Column(Text, nullable=True)
     category = Column(Text, nullable=True)
+    sentiment_tier = Column(String, nullable=True)  # which tier answered: 'local' or 'llm'
+    category_tier = Column(String, nullable=True)
+    sentiment_value = Column(SmallInteger, nullable=True, index=True)  # -1, 0 or 1
+    category_mask = Column(Integer, nullable=True)  # bit i set for parsing.CATEGORIES[i]
     ts = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # Database time of the last insert or update, which tells rollup.py what to recount
+    updated_at = Column(DateTime, nullable=True, index=True, server_default=func.timezone("utc", func.now()))
 
     __table_args__ = (
         PrimaryKeyConstraint("ucid", "service"),
+        # Keyset pagination walks (ts, ucid, service), optionally within one service
+        Index("ix_query_results_ts", "ts", "ucid", "service"),
+        Index("ix_query_results_service_ts", "service", "ts", "ucid"),
     )
+
+
+# Row counts of query_results per service, hour and answer, refreshed periodically by rollup.py
+# so that analytics never scan query_results.
+query_result_rollup = Table(
+    "query_result_rollup",
+    Base.metadata,
+    Column("service", String, nullable=False),
+    Column("bucket", DateTime, nullable=False),  # ts truncated to the hour
+    Column("sentiment_value", SmallInteger, nullable=True),
+    Column("category_mask", Integer, nullable=True),
+    Column("count", BigInteger, nullable=False, default=0),
+    UniqueConstraint(
+        "service", "bucket", "sentiment_value", "category_mask",
+        name="uq_query_result_rollup", postgresql_nulls_not_distinct=True,
+    ),
+)
+
+# The updated_at up to which query_result_rollup is up to date, in a single row with id 1.
+query_result_rollup_state = Table(
+    "query_result_rollup_state",
+    Base.metadata,
+    Column("id", SmallInteger, primary_key=True, autoincrement=False),
+    Column("watermark", DateTime, nullable=False),
+)
+
+
+# LLM requests per lane of every process using the backends, see admission.ClusterBudget.
+llm_admission_usage = Table(
+    "llm_admission_usage",
+    Base.metadata,
+    Column("process", String, primary_key=True),  # host:pid
+    Column("interactive_waiting", Integer, nullable=False),
+    Column("batch_waiting", Integer, nullable=False),
+    Column("background_active", Integer, nullable=False),
+    Column("background_waiting", Integer, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+)
+
+
+class CachedResult(Base):
+    """LLM results keyed by a hash of the normalized text, task, prompt version and model."""
+    __tablename__ = "llm_cache"
+    key = Column(String(64), primary_key=True)
+    task = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    value = Column(Text, nullable=False)
+    ts = Column(DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,106 @@
+import json
+import re
+
+from llm_client import LLMError
+
+CATEGORIES = (
+    "Politics", "Technology", "Entertainment", "Sports", "Science",
+    "Health", "Ecology", "Finance", "Cars", "Other",
+)
+SENTIMENTS = (-1, 0, 1)
+SENTIMENT_WORDS = {"negative": -1, "neutral": 0, "positive": 1}
+# raw answer column -> typed column
+TYPED_COLUMNS = {"sentiment": "sentiment_value", "category": "category_mask"}
+
+_number = re.compile(r"[+-]?\d+")
+_categories_by_name = {category.lower(): category for category in CATEGORIES}
+
+
+class AnalysisParseError(LLMError, ValueError):
+    """Raised when the model output does not match the expected format."""
+
+
+def format_categories(categories) -> str:
+    """Serialize categories the same way the category prompt asks the model to answer."""
+    return json.dumps(list(categories), separators=(",", ":"))
+
+
+def parse_sentiment(output: str) -> int:
+    """
+    Maps a sentiment answer such as "1", " -1." or "Answer: 0" to -1, 0 or 1.
+    A single sentiment word ("positive") is accepted as well.
+    """
+    match = _number.search(output or "")
+    if match and int(match.group()) in SENTIMENTS:
+        return int(match.group())
+    words = {word for word in re.findall(r"[a-z]+", (output or "").lower()) if word in SENTIMENT_WORDS}
+    if len(words) == 1:
+        return SENTIMENT_WORDS[words.pop()]
+    raise AnalysisParseError(f"Invalid sentiment output: {output!r}")
+
+
+def validate_sentiment(value, output) -> int:
+    """A sentiment from a decoded JSON answer: the number -1, 0 or 1, or a string parse_sentiment accepts."""
+    if isinstance(value, str):
+        return parse_sentiment(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value in SENTIMENTS:
+        return int(value)
+    raise AnalysisParseError(f"Invalid sentiment output: {output!r}")
+
+
+def validate_categories(categories, output) -> list:
+    """
+    Maps decoded category names (or a single name) to the list of known category names,
+    in the order given and without duplicates.
+    """
+    if isinstance(categories, str):
+        categories = [categories]
+    if not isinstance(categories, list) or not categories:
+        raise AnalysisParseError(f"Invalid categories output: {output!r}")
+
+    names = []
+    for category in categories:
+        name = _categories_by_name.get(category.strip().lower()) if isinstance(category, str) else None
+        if name is None:
+            raise AnalysisParseError(f"Unknown category in output: {output!r}")
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def parse_categories(output: str) -> list:
+    """
+    Maps a category answer such as '["Sports","health"]' to the list of known category names,
+    in the order given and without duplicates.
+    """
+    start, end = (output or "").find("["), (output or "").rfind("]")
+    try:
+        categories = json.loads(output[start:end + 1]) if 0 <= start < end else None
+    except ValueError:
+        categories = None
+    return validate_categories(categories, output)
+
+
+def category_mask(categories) -> int:
+    """Bitmask with bit i set for CATEGORIES[i]."""
+    mask = 0
+    for category in categories:
+        mask |= 1 << CATEGORIES.index(category)
+    return mask
+
+
+def categories_from_mask(mask: int) -> list:
+    return [category for i, category in enumerate(CATEGORIES) if mask & (1 << i)]
+
+
+def typed_fields(fields: dict) -> dict:
+    """
+    Adds the typed columns for the analysis fields present: sentiment_value (-1, 0 or 1)
+    next to sentiment and category_mask next to category.
+    """
+    typed = dict(fields)
+    if "sentiment" in fields:
+        typed[TYPED_COLUMNS["sentiment"]] = parse_sentiment(fields["sentiment"])
+    if "category" in fields:
+        typed[TYPED_COLUMNS["category"]] = category_mask(parse_categories(fields["category"]))
+    return typed
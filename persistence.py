@@ -0,0 +1,174 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from config import WRITE_BUFFER_MAX_ROWS, WRITE_BUFFER_FLUSH_INTERVAL
+from db import SessionLocal
+from metrics import DB_COMMIT_LATENCY, DB_ROWS_WRITTEN
+from orm_models import QueryResult
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_COLUMNS = ("sentiment", "category", "sentiment_tier", "category_tier", "sentiment_value", "category_mask")
+
+
+def get_query_result(db, ucid, service):
+    """Return the stored QueryResult for the key, or None."""
+    return db.get(QueryResult, (ucid, service))
+
+
+def merge_rows(rows):
+    """
+    Merge rows with the same (ucid, service) key, later values winning.
+    PostgreSQL refuses to update the same row twice in one INSERT ... ON CONFLICT.
+    """
+    merged = {}
+    for row in rows:
+        key = (row["ucid"], row["service"])
+        merged[key] = {**merged.get(key, {}), **row}
+    return list(merged.values())
+
+
+def upsert_statements(rows):
+    """
+    Build the INSERT ... ON CONFLICT statements on (ucid, service) that store the rows in bulk.
+    Each row is a dict with ucid, service and text plus the analysis columns to store;
+    on conflict only the analysis columns present in the row are overwritten, and updated_at
+    is stamped so the analytics rollup recounts the row.
+    """
+    groups = {}
+    for row in merge_rows(rows):
+        columns = tuple(column for column in ANALYSIS_COLUMNS if column in row)
+        groups.setdefault(columns, []).append(row)
+
+    for columns, group in groups.items():
+        statement = insert(QueryResult).values(group)
+        if columns:
+            statement = statement.on_conflict_do_update(
+                index_elements=["ucid", "service"],
+                set_={
+                    **{column: statement.excluded[column] for column in columns},
+                    "updated_at": func.timezone("utc", func.now()),
+                },
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=["ucid", "service"])
+        yield statement
+
+
+def upsert_query_results(db, rows):
+    """Insert or update QueryResult rows in bulk. Does not commit."""
+    for statement in upsert_statements(rows):
+        db.execute(statement)
+
+
+async def save_query_results_async(db, rows):
+    """Upsert the rows through an async session and commit them in one transaction."""
+    try:
+        with DB_COMMIT_LATENCY.time():
+            for statement in upsert_statements(rows):
+                await db.execute(statement)
+            await db.commit()
+        DB_ROWS_WRITTEN.inc(len(rows))
+    except Exception:
+        await db.rollback()
+        raise
+
+
+def save_query_results(rows):
+    """Upsert the rows and commit them in one transaction."""
+    db = SessionLocal()
+    try:
+        with DB_COMMIT_LATENCY.time():
+            upsert_query_results(db, rows)
+            db.commit()
+        DB_ROWS_WRITTEN.inc(len(rows))
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+class WriteBuffer:
+    """
+    Collects rows from many callers and writes them with one bulk upsert per flush.
+    A flush happens once max_rows rows are waiting or flush_interval seconds after the
+    first row arrived. add() returns a Future that resolves when the row is committed,
+    so callers can still wait for durability before acknowledging their work.
+    """
+
+    def __init__(self, max_rows=WRITE_BUFFER_MAX_ROWS, flush_interval=WRITE_BUFFER_FLUSH_INTERVAL):
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._futures = []
+        self._first_added = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def add(self, row) -> Future:
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write buffer is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-buffer", daemon=True)
+                self._thread.start()
+            if not self._rows:
+                self._first_added = time.monotonic()
+            self._rows.append(row)
+            self._futures.append(future)
+            if len(self._rows) == 1 or len(self._rows) >= self.max_rows:
+                self._condition.notify()
+        return future
+
+    def close(self):
+        """Flush the remaining rows and stop the flusher thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _take(self):
+        with self._condition:
+            while True:
+                if self._rows:
+                    remaining = self._first_added + self.flush_interval - time.monotonic()
+                    if len(self._rows) >= self.max_rows or remaining <= 0 or self._closed:
+                        break
+                    self._condition.wait(remaining)
+                elif self._closed:
+                    return None, None
+                else:
+                    self._condition.wait()
+            rows, self._rows = self._rows[:self.max_rows], self._rows[self.max_rows:]
+            futures, self._futures = self._futures[:self.max_rows], self._futures[self.max_rows:]
+            return rows, futures
+
+    def _run(self):
+        while True:
+            rows, futures = self._take()
+            if rows is None:
+                return
+            try:
+                save_query_results(rows)
+            except Exception as e:
+                logger.error(f"Failed to write {len(rows)} query results: {e}")
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(None)
+
+
+write_buffer = WriteBuffer()
+atexit.register(write_buffer.close)
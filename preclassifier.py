@@ -0,0 +1,88 @@
+import re
+
+from config import PRECLASSIFIER_MIN_HITS, PRECLASSIFIER_SENTIMENT_THRESHOLD, PRECLASSIFIER_CATEGORY_THRESHOLD
+
+TIER_LOCAL = "local"
+TIER_LLM = "llm"
+
+_words = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+
+POSITIVE_WORDS = frozenset("""
+    amazing awesome beautiful best brilliant congrats congratulations cool cute delicious enjoy enjoyed
+    excellent fantastic favorite favourite fun glad good gorgeous great happy incredible love loved lovely
+    nice perfect recommend superb thank thanks win winner wonderful wow yay
+""".split())
+
+NEGATIVE_WORDS = frozenset("""
+    angry annoying awful bad boring broken crap cringe disappointed disappointing disgusting dislike fail
+    failed fake hate hated horrible lie lies poor sad scam stupid sucks terrible trash ugly useless waste
+    worse worst wrong
+""".split())
+
+NEGATIONS = frozenset("not no never don't doesn't didn't isn't wasn't aren't can't won't nothing".split())
+
+CATEGORY_KEYWORDS = {
+    "Politics": "election elections government minister parliament party president senate vote voting war",
+    "Technology": "ai app apps computer gadget iphone internet laptop phone robot smartphone software tech",
+    "Entertainment": "actor album celebrity concert film movie movies music series show singer song trailer",
+    "Sports": "basketball champion championship football goal league match olympics player soccer team tennis",
+    "Science": "astronomy biology chemistry discovery experiment nasa physics research scientist scientists space",
+    "Health": "diet disease doctor fitness health hospital medicine mental symptoms therapy vaccine workout",
+    "Ecology": "climate ecology environment forest plastic pollution recycling renewable sustainability wildlife",
+    "Finance": "bank bitcoin crypto dollar economy finance investing investment market money stock stocks",
+    "Cars": "bmw car cars drift driving engine ferrari horsepower motor porsche tesla vehicle",
+}
+_category_index = {
+    word: category for category, words in CATEGORY_KEYWORDS.items() for word in words.split()
+}
+
+
+def tokenize(text: str):
+    return _words.findall(text.lower())
+
+
+def predict_sentiment(text: str):
+    """
+    Scores the text against the sentiment lexicon, flipping words preceded by a negation.
+    Returns "-1" or "1" when the lexicon is confident enough, otherwise None.
+    Neutral texts are never answered locally.
+    """
+    positive = negative = 0
+    previous = None
+    for word in tokenize(text):
+        polarity = (word in POSITIVE_WORDS) - (word in NEGATIVE_WORDS)
+        if previous in NEGATIONS:
+            polarity = -polarity
+        if polarity > 0:
+            positive += 1
+        elif polarity < 0:
+            negative += 1
+        previous = word
+
+    hits = positive + negative
+    if hits < PRECLASSIFIER_MIN_HITS:
+        return None
+    confidence = abs(positive - negative) / (hits + 1)
+    if confidence < PRECLASSIFIER_SENTIMENT_THRESHOLD:
+        return None
+    return "1" if positive > negative else "-1"
+
+
+def predict_category(text: str):
+    """
+    Counts category keywords in the text.
+    Returns a one-category JSON array when a single category clearly dominates, otherwise None.
+    """
+    counts = {}
+    for word in tokenize(text):
+        category = _category_index.get(word)
+        if category:
+            counts[category] = counts.get(category, 0) + 1
+    if not counts:
+        return None
+
+    category, hits = max(counts.items(), key=lambda item: item[1])
+    confidence = hits / (sum(counts.values()) + 1)
+    if hits < PRECLASSIFIER_MIN_HITS or confidence < PRECLASSIFIER_CATEGORY_THRESHOLD:
+        return None
+    return f'["{category}"]'
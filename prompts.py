@@ -0,0 +1,149 @@
+"""
+The prompts sent to the LLM, each with the generation profile it is answered with.
+The profiles cap the output at the length of a valid answer and decode greedily, so a model
+that starts explaining itself is cut off instead of holding a slot until LLM_READ_TIMEOUT.
+"""
+import hashlib
+import json
+
+from config import LLM_PROFILES, LLM_STRUCTURED_OUTPUT
+from llm_client import GenerationProfile
+from parsing import CATEGORIES, SENTIMENTS
+
+# Part of the cache key: bump it whenever a prompt or a default profile changes so stale results
+# are not reused. Profiles changed by configuration are covered by CACHE_VERSION.
+PROMPT_VERSION = 3
+
+prompt_sentiment = (
+    "Please determine the emotional tone of the text (positive, negative, or neutral). "
+    "Answer strictly with a single number without any explanations:\n"
+    "-1 for negative\n"
+    "0 for neutral\n"
+    "1 for positive\n\n"
+    "Text:\n{}\n\n"
+    "Answer:"
+)
+
+prompt_category = (
+    "Identify which of the following possible categories best fits this text:\n\n"
+    "1) Politics\n"
+    "2) Technology\n"
+    "3) Entertainment\n"
+    "4) Sports\n"
+    "5) Science\n"
+    "6) Health\n"
+    "7) Ecology\n"
+    "8) Finance\n"
+    "9) Cars\n"
+    "10) Other\n\n"
+    "You can select multiple categories (up to three) if it is really justified. "
+    "If you are unsure, select 'Other'.\n\n"
+    "Return the result strictly in JSON array format (for example: [\"Technology\"] or [\"Sports\",\"Health\"]). "
+    "Do not add any additional text.\n\n"
+    "Text:\n{}\n\n"
+    "Answer:"
+)
+
+prompt_analysis = (
+    "Analyze the text below and answer two questions.\n\n"
+    "1) The emotional tone of the text: -1 for negative, 0 for neutral, 1 for positive.\n"
+    "2) Which of the following categories best fit the text: "
+    "Politics, Technology, Entertainment, Sports, Science, Health, Ecology, Finance, Cars, Other. "
+    "You can select multiple categories (up to three) if it is really justified. "
+    "If you are unsure, select 'Other'.\n\n"
+    "Return the result strictly as a JSON object in the format "
+    "{{\"sentiment\": 0, \"categories\": [\"Technology\"]}}. "
+    "Do not add any additional text.\n\n"
+    "Text:\n{}\n\n"
+    "Answer:"
+)
+
+prompt_batch_analysis = (
+    "Analyze each of the numbered texts below and answer two questions for every text.\n\n"
+    "1) The emotional tone of the text: -1 for negative, 0 for neutral, 1 for positive.\n"
+    "2) Which of the following categories best fit the text: "
+    "Politics, Technology, Entertainment, Sports, Science, Health, Ecology, Finance, Cars, Other. "
+    "You can select multiple categories (up to three) if it is really justified. "
+    "If you are unsure, select 'Other'.\n\n"
+    "Return the result strictly as a JSON object with one entry per text in the format "
+    "{{\"results\": [{{\"id\": 1, \"sentiment\": 0, \"categories\": [\"Technology\"]}}]}}. "
+    "Do not add any additional text.\n\n"
+    "Texts:\n{}\n\n"
+    "Answer:"
+)
+
+# Sent with the profile of the task whose answer could not be parsed.
+prompt_retry = (
+    "{prompt} {output}\n\n"
+    "This answer does not follow the required format. {instruction} "
+    "Do not add any additional text.\n\n"
+    "Answer:"
+)
+
+
+class Prompt:
+    def __init__(self, name, template, profile):
+        self.name = name
+        self.template = template
+        self.profile = profile
+
+    def render(self, text: str) -> str:
+        return self.template.format(text)
+
+
+_categories_schema = {
+    "type": "array", "items": {"type": "string", "enum": list(CATEGORIES)}, "minItems": 1, "maxItems": 3,
+}
+_analysis_schema = {
+    "type": "object",
+    "properties": {"sentiment": {"type": "integer", "enum": list(SENTIMENTS)}, "categories": _categories_schema},
+    "required": ["sentiment", "categories"],
+}
+_batch_schema = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": {
+        **_analysis_schema,
+        "properties": {"id": {"type": "integer"}, **_analysis_schema["properties"]},
+        "required": ["id", *_analysis_schema["required"]],
+    }}},
+    "required": ["results"],
+}
+
+
+def _structured(schema, fallback=None):
+    """A JSON schema constraining the output when LLM_STRUCTURED_OUTPUT is on, otherwise `fallback`."""
+    return schema if LLM_STRUCTURED_OUTPUT else fallback
+
+
+# Budgets leave room for the longest valid answer, such as '-1' or '["Entertainment","Technology","Science"]',
+# with some slack for the whitespace of JSON mode. For the batch prompt max_tokens is per text, see batch_profile().
+# Stop sequences are cut from the output, so none is used that a valid answer ends with.
+PROMPTS = {
+    "sentiment": Prompt("sentiment", prompt_sentiment, GenerationProfile(
+        max_tokens=4, temperature=0, format=_structured({"type": "integer", "enum": list(SENTIMENTS)}),
+    )),
+    "category": Prompt("category", prompt_category, GenerationProfile(
+        max_tokens=32, stop=("\n\n",), temperature=0, format=_structured(_categories_schema),
+    )),
+    "analysis": Prompt("analysis", prompt_analysis, GenerationProfile(
+        max_tokens=64, temperature=0, format=_structured(_analysis_schema, "json"),
+    )),
+    "batch_analysis": Prompt("batch_analysis", prompt_batch_analysis, GenerationProfile(
+        max_tokens=48, temperature=0, format=_structured(_batch_schema, "json"),
+    )),
+}
+
+for _name, _changes in (json.loads(LLM_PROFILES) if LLM_PROFILES else {}).items():
+    PROMPTS[_name].profile = PROMPTS[_name].profile.replace(**_changes)
+
+# The prompt version as used in cache keys: it also changes with the effective profiles, e.g. with
+# LLM_PROFILES or LLM_STRUCTURED_OUTPUT, so answers generated with other settings are not reused.
+CACHE_VERSION = f"{PROMPT_VERSION}-" + hashlib.sha256(
+    "\x00".join(f"{name}\x00{prompt.profile.output_settings()}" for name, prompt in sorted(PROMPTS.items())).encode()
+).hexdigest()[:12]
+
+
+def batch_profile(count: int) -> GenerationProfile:
+    """The batch prompt's profile with a budget for `count` answers."""
+    profile = PROMPTS["batch_analysis"].profile
+    return profile.replace(max_tokens=None if profile.max_tokens is None else 16 + profile.max_tokens * count)
@@ -1,93 +1,73 @@
 import json
 import logging
-import requests
 from fastapi import HTTPException
 
-from rabbit.rabbitmq import RabbitMQ
+import analysis
+import llm_client
+from rabbit.publisher import get_publisher
 from db import engine, SessionLocal
 from orm_models import Base, QueryResult
 from models import QueryRequest, QueryResponse
+from metrics import timed
+from persistence import get_query_result, write_buffer
+from singleflight import ThreadSingleFlight, process_lock
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-prompt_sentiment = (
-    "Please determine the emotional tone of the text (positive, negative, or neutral). "
-    "Answer strictly with a single number without any explanations:\n"
-    "-1 for negative\n"
-    "0 for neutral\n"
-    "1 for positive\n\n"
-    "Text:\n{}\n\n"
-    "Answer:"
-)
-
-prompt_category = (
-    "Identify which of the following possible categories best fits this text:\n\n"
-    "1) Politics\n"
-    "2) Technology\n"
-    "3) Entertainment\n"
-    "4) Sports\n"
-    "5) Science\n"
-    "6) Health\n"
-    "7) Ecology\n"
-    "8) Finance\n"
-    "9) Cars\n"
-    "10) Other\n\n"
-    "You can select multiple categories (up to three) if it is really justified. "
-    "If you are unsure, select 'Other'.\n\n"
-    "Return the result strictly in JSON array format (for example: [\"Technology\"] or [\"Sports\",\"Health\"]). "
-    "Do not add any additional text.\n\n"
-    "Text:\n{}\n\n"
-    "Answer:"
-)
-
-ollama_url = "http://40.113.50.250:8080/llama/api/generate"
-
-
-def query_ollama(prompt: str) -> str:
+
+def analyze_text(text: str):
     """
-    Sends a prompt to the local Ollama server and returns the result.
+    Runs sentiment and category analysis on the text and returns the results and
+    the tier that answered each of them, keyed by column name.
+    Blocks the calling thread while the shared async client does the requests.
     """
     try:
-        response = requests.post(ollama_url, json={"model": "llama3.1", "prompt": prompt, "stream": False})
-        response.raise_for_status()
-        return response.json().get("response", "").strip()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ollama server error: {e}")
-        raise HTTPException(status_code=500, detail=f"Ollama server error: {e}")
+        return llm_client.run_sync(analysis.classify_text(text))
+    except llm_client.LLMError as e:
+        logger.error(str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Redeliveries of a message being processed wait for the first delivery instead of redoing it.
+_query_results_in_flight = ThreadSingleFlight("query_result")
 
 
 def get_or_create_query_result(db, ucid, service, text):
     """
     If a record with the given ucid and service already exists, return it.
-    Otherwise, create a new record with the provided ucid, text, and service.
+    Otherwise, analyze the text and store a new record through the write buffer,
+    waiting until it is committed so the message is acked only afterwards.
+    Concurrent calls for the same ucid and service share one analysis and one write.
     """
-    record = db.query(QueryResult).filter(
-        QueryResult.ucid == ucid, QueryResult.service == service
-    ).first()
+    return _query_results_in_flight.do(
+        (ucid, service), lambda: _get_or_create_query_result(db, ucid, service, text)
+    )
 
-    # If the record doesn't exist, we create one (and do sentiment/category analysis).
-    if not record:
-        if not text or not text.strip():
-            logger.warning(
-                f"Empty or whitespace text received for UCID: {ucid} with service: {service}. Skipping processing."
-            )
-            return None
 
-        sentiment = query_ollama(prompt_sentiment.format(text))
-        category = query_ollama(prompt_category.format(text))
+def _get_or_create_query_result(db, ucid, service, text):
+    # With SINGLEFLIGHT_ADVISORY_LOCK, other worker processes wait here and then find the record.
+    with process_lock(f"query_result:{service}:{ucid}"):
+        with timed("db_lookup"):
+            record = get_query_result(db, ucid, service)
+
+        # If the record doesn't exist, we create one (and do sentiment/category analysis).
+        if not record:
+            if not text or not text.strip():
+                logger.warning(
+                    f"Empty or whitespace text received for UCID: {ucid} with service: {service}. Skipping processing."
+                )
+                return None
+
+            with timed("analysis"):
+                fields = analyze_text(text)
 
-        record = QueryResult(
-            ucid=ucid,
-            text=text,
-            service=service,
-            sentiment=sentiment,
-            category=category
-        )
-        db.add(record)
+            record = QueryResult(ucid=ucid, text=text, service=service, **fields)
+            with timed("db_write"):
+                write_buffer.add({"ucid": ucid, "service": service, "text": text, **fields}).result()
 
-    return record
+        return record
 
 
 def callback_text_ai(ch, method, properties, body):
@@ -96,7 +76,7 @@ def callback_text_ai(ch, method, properties, body):
     """
     try:
         data = json.loads(body)
-        logger.info(f"Received data in callback_text_ai: {data}")
+        logger.debug(f"Received data in callback_text_ai: {data}")
 
         ucid = data.get('UCID')
         video_id = data.get('VideoId', {})
@@ -106,6 +86,7 @@ def callback_text_ai(ch, method, properties, body):
         # Further processing...
     except Exception as e:
         logger.error(f"Error in callback_text_ai: {e}")
+        raise
 
 
 def callback_video_ocr(ch, method, properties, body):
@@ -116,7 +97,7 @@ def callback_video_ocr(ch, method, properties, body):
     db = SessionLocal()
     try:
         data = json.loads(body)
-        logger.info(f"Received data in callback_video_ocr: {data}")
+        logger.debug(f"Received data in callback_video_ocr: {data}")
 
         ucid = data.get('UCID')
         text = data.get('text', '')
@@ -136,14 +117,17 @@ def callback_video_ocr(ch, method, properties, body):
             "UCID": ucid,
             "sentiment": record.sentiment,
             "category": record.category,
+            "sentiment_value": record.sentiment_value,
+            "category_mask": record.category_mask,
             "service": service,
         }
-        logger.info(f"Sending message from callback_video_ocr: {message}")
+        logger.debug(f"Sending message from callback_video_ocr: {message}")
 
-        rabbit = RabbitMQ()
-        rabbit.send_to_queue("text_ai_to_analyze", message)
+        with timed("publish"):
+            get_publisher().publish("text_ai_to_analyze", message)
     except Exception as e:
         logger.error(f"Error in callback_video_ocr: {e}")
+        raise
     finally:
         db.close()
 
@@ -155,7 +139,7 @@ def callback_video_text_extraction(ch, method, properties, body):
     db = SessionLocal()
     try:
         data = json.loads(body)
-        logger.info(f"Received data in callback_video_text_extraction: {data}")
+        logger.debug(f"Received data in callback_video_text_extraction: {data}")
 
         ucid = data.get('UCID')
         text = data.get('text', '')
@@ -175,14 +159,17 @@ def callback_video_text_extraction(ch, method, properties, body):
             "UCID": ucid,
             "sentiment": record.sentiment,
             "category": record.category,
+            "sentiment_value": record.sentiment_value,
+            "category_mask": record.category_mask,
             "service": service,
         }
-        logger.info(f"Sending message from callback_video_text_extraction: {message}")
+        logger.debug(f"Sending message from callback_video_text_extraction: {message}")
 
-        rabbit = RabbitMQ()
-        rabbit.send_to_queue("text_ai_to_analyze", message)
+        with timed("publish"):
+            get_publisher().publish("text_ai_to_analyze", message)
     except Exception as e:
         logger.error(f"Error in callback_video_text_extraction: {e}")
+        raise
     finally:
         db.close()
 
@@ -195,7 +182,7 @@ def callback_text_around(ch, method, properties, body):
     db = SessionLocal()
     try:
         data = json.loads(body)
-        logger.info(f"Received data in callback_text_around: {data}")
+        logger.debug(f"Received data in callback_text_around: {data}")
 
         ucid = data.get('UCID')
         text = data.get('text', '')
@@ -215,13 +202,16 @@ def callback_text_around(ch, method, properties, body):
             "UCID": ucid,
             "sentiment": record.sentiment,
             "category": record.category,
+            "sentiment_value": record.sentiment_value,
+            "category_mask": record.category_mask,
             "service": service,
         }
-        logger.info(f"Sending message from callback_text_around: {message}")
+        logger.debug(f"Sending message from callback_text_around: {message}")
 
-        rabbit = RabbitMQ()
-        rabbit.send_to_queue("text_ai_to_analyze", message)
+        with timed("publish"):
+            get_publisher().publish("text_ai_to_analyze", message)
     except Exception as e:
         logger.error(f"Error in callback_text_around: {e}")
+        raise
     finally:
         db.close()
@@ -1,27 +1,81 @@
+import logging
+import random
+import signal
+import threading
+
+import pika
+
 from rabbit.rabbitmq import RabbitMQ
 from rabbit.callbacks import callback_text_ai, callback_video_ocr, callback_video_text_extraction
-from config import COMMENT_HANDLER_QUEUE, VIDEO_OCR_TEXT_HANDLER_QUEUE, VIDEO_TEXT_EXTRACTION_QUEUE
+from config import (
+    COMMENT_HANDLER_QUEUE, VIDEO_OCR_TEXT_HANDLER_QUEUE, VIDEO_TEXT_EXTRACTION_QUEUE, RABBIT_CONSUMER_MODE,
+    WORKER_METRICS_PORT, RABBIT_RECONNECT_MIN_DELAY, RABBIT_RECONNECT_MAX_DELAY,
+)
+import llm_client
+import metrics
+
+logger = logging.getLogger(__name__)
 
-import time, pika
+# queue name -> callback
+CONSUMERS = {
+    COMMENT_HANDLER_QUEUE: callback_text_ai,
+    VIDEO_OCR_TEXT_HANDLER_QUEUE: callback_video_ocr,
+    VIDEO_TEXT_EXTRACTION_QUEUE: callback_video_text_extraction,
+}
 
 
-def start_consumer():
+def backoff_delays(initial=RABBIT_RECONNECT_MIN_DELAY, maximum=RABBIT_RECONNECT_MAX_DELAY):
+    """Reconnect delays doubling from `initial` up to `maximum`, jittered so workers don't retry in step."""
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, maximum)
+
+
+def start_consumer(queues=None, metrics_port=WORKER_METRICS_PORT):
     """
     The main loop of connecting consumer to RabbitMQ and waiting for messages.
-    If the connection is broken, there will be an attempt to reconnect after 5 seconds.
+    queues: names of the queues to consume, all of CONSUMERS by default.
+    If the connection is broken, it reconnects after exponentially growing delays.
+    In 'concurrent' mode messages are processed in parallel and acked after processing,
+    in 'blocking' mode they are auto-acked and processed one at a time.
+    SIGTERM stops consuming; in 'concurrent' mode the messages being processed are finished first.
+    The model is loaded before the first message is taken, see llm_client.warm_up.
     """
-    while True:
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    llm_client.run_sync(llm_client.warm_up())
+    consumers = [(queue_name, CONSUMERS[queue_name]) for queue_name in (queues or CONSUMERS)]
+    stopping = threading.Event()
+    rabbit = None
+
+    def stop(signum, frame):
+        logger.info("Received SIGTERM, stopping the consumer")
+        stopping.set()
+        if rabbit is not None:
+            rabbit.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    delays = backoff_delays()
+    while not stopping.is_set():
+        rabbit = None
         try:
-            consumers = [
-                (COMMENT_HANDLER_QUEUE, callback_text_ai),
-                (VIDEO_OCR_TEXT_HANDLER_QUEUE, callback_video_ocr),
-                (VIDEO_TEXT_EXTRACTION_QUEUE, callback_video_text_extraction),
-            ]
             rabbit = RabbitMQ()
-            rabbit.start_multiple_consumers(consumers)
-        except pika.exceptions.AMQPConnectionError:
-            print("Error connecting to queue")  # TODO: change print to save log
-            time.sleep(5)
+            delays = backoff_delays()  # connected, so the next failure starts from the shortest delay
+            if stopping.is_set():
+                break
+            if RABBIT_CONSUMER_MODE == 'concurrent':
+                rabbit.start_concurrent_consumers(consumers)
+            else:
+                rabbit.start_multiple_consumers(consumers)
+        except pika.exceptions.AMQPError as e:
+            delay = next(delays)
+            logger.error(f"Lost the RabbitMQ connection ({e!r}), reconnecting in {delay:.1f}s")
+            stopping.wait(delay)
+        finally:
+            if rabbit is not None:
+                rabbit.close_connection()
+    logger.info("Consumer stopped")
 
 
 if __name__ == '__main__':
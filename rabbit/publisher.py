@@ -0,0 +1,175 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import pika
+
+from config import RABBIT_PUBLISH_BATCH_SIZE, RABBIT_PUBLISH_LINGER
+from rabbit.rabbitmq import RabbitMQ
+
+logger = logging.getLogger(__name__)
+
+
+class Publisher:
+    """
+    Long-lived publisher that owns one RabbitMQ connection and channel.
+
+    pika connections are not thread-safe, so all I/O happens in a single publisher
+    thread: callers enqueue messages, the thread publishes them in batches of up to
+    `batch_size` (waiting at most `linger` seconds to fill a batch) inside an AMQP
+    transaction and resolves each caller's future once the broker has committed it.
+    Declared queues are remembered, and a broken connection is reopened and the batch
+    retried once.
+
+    Transactions are used instead of publisher confirms on purpose: with pika's blocking
+    adapter, confirm_delivery() makes every basic_publish wait for its own ack, one round
+    trip per message. A transaction costs one round trip per batch, but tx.commit is
+    synchronous and heavier for the broker than confirms, so a batch blocks the thread until
+    the broker has handled it, and throughput stays below what asynchronous, pipelined
+    confirms (which need pika's asynchronous adapters) could reach.
+    """
+
+    def __init__(self, batch_size=RABBIT_PUBLISH_BATCH_SIZE, linger=RABBIT_PUBLISH_LINGER, rabbit=None):
+        self.batch_size = batch_size
+        self.linger = linger
+        self._pending = queue.Queue()
+        self._rabbit = rabbit  # connected lazily when None
+        self._channel = None
+        self._declared = set()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closing = False
+
+    def publish(self, queue_name, params, wait=True):
+        """
+        Publish a message to a queue. Blocks until the transaction holding it is committed
+        unless wait=False, in which case a Future is returned.
+        """
+        future = self._enqueue(queue_name, params)
+        return future.result() if wait else future
+
+    def publish_batch(self, queue_name, messages, wait=True):
+        """Publish several messages to a queue; they are committed together."""
+        futures = [self._enqueue(queue_name, params) for params in messages]
+        if wait:
+            for future in futures:
+                future.result()
+        return futures
+
+    def close(self):
+        """Flush pending messages and close the connection."""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._closing = True
+            self._pending.put(None)
+        self._thread.join()
+
+    def _enqueue(self, queue_name, params):
+        future = Future()
+        with self._lock:
+            if self._closing:
+                raise RuntimeError("Publisher is closed")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rabbit-publisher", daemon=True)
+                self._thread.start()
+            self._pending.put((queue_name, json.dumps(params), future))
+        return future
+
+    def _channel_for(self, queue_name):
+        if self._channel is None or self._channel.is_closed:
+            if self._rabbit is None:
+                self._rabbit = RabbitMQ()
+            self._rabbit.create_connection()
+            self._channel = self._rabbit.connection.channel()
+            self._channel.tx_select()
+            self._declared.clear()
+        if queue_name not in self._declared:
+            self._channel.queue_declare(queue=queue_name, durable=True, arguments=RabbitMQ.QUEUE_DECLARE_ARGS)
+            self._declared.add(queue_name)
+        return self._channel
+
+    def _send(self, batch):
+        for queue_name, body, _ in batch:
+            self._channel_for(queue_name).basic_publish(
+                exchange='',
+                routing_key=queue_name,
+                body=body,
+                properties=pika.BasicProperties(delivery_mode=2, timestamp=int(time.time()))
+            )
+        self._channel.tx_commit()
+
+    def _reset(self):
+        if self._rabbit is not None:
+            try:
+                self._rabbit.close_connection()
+            except Exception:
+                pass
+        self._rabbit = None
+        self._channel = None
+
+    def _next_batch(self):
+        """Wait for the first message, then collect more until the batch is full or linger expires."""
+        while True:
+            try:
+                item = self._pending.get(timeout=1)
+                break
+            except queue.Empty:
+                # Keep heartbeats flowing while idle.
+                if self._rabbit is not None and self._rabbit.connection.is_open:
+                    self._rabbit.connection.process_data_events(time_limit=0)
+        batch = []
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            try:
+                item = self._pending.get(timeout=self.linger)
+            except queue.Empty:
+                break
+        return batch, item is None
+
+    def _run(self):
+        stop = False
+        while not stop:
+            try:
+                batch, stop = self._next_batch()
+            except pika.exceptions.AMQPError as e:
+                logger.warning(f"Publisher connection lost while idle: {e}")
+                self._reset()
+                continue
+            if not batch:
+                continue
+            for attempt in (1, 2):
+                try:
+                    self._send(batch)
+                    error = None
+                    break
+                except Exception as e:
+                    logger.warning(f"Publishing a batch of {len(batch)} failed (attempt {attempt}): {e}")
+                    error = e
+                    self._reset()
+            for _, _, future in batch:
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        self._reset()
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> Publisher:
+    """Return the process-wide publisher."""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher()
+            atexit.register(_publisher.close)
+    return _publisher
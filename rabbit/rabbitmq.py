@@ -1,6 +1,20 @@
 import pika
+import copy
 import json
-from config import RABBIT_HOST, RABBIT_PORT, RABBIT_USER, RABBIT_PASSWORD
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+from config import (
+    RABBIT_HOST, RABBIT_PORT, RABBIT_USER, RABBIT_PASSWORD, RABBIT_PREFETCH_COUNT, RABBIT_WORKERS, RABBIT_DRAIN_TIMEOUT,
+    RABBIT_RETRY_DELAY, RABBIT_MAX_RETRIES,
+)
+from metrics import QUEUE_WAIT, WORKER_WAIT, MESSAGE_LATENCY, MESSAGES
+
+logger = logging.getLogger(__name__)
 
 
 class RabbitMQ:
@@ -8,16 +22,19 @@ class RabbitMQ:
     QUEUE_DECLARE_ARGS = {
         'x-message-ttl': 43200000  # Message Time to Live (TTL) in milliseconds (12 hour)
     }
+    # Retrying these can never succeed, so such messages are dropped instead.
+    POISON_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
 
     def __init__(self):
         """Initialize and create a persistent RabbitMQ connection."""
         self.connection = None
+        self._stopping = threading.Event()
         self.create_connection()
 
     def create_connection(self):
         """Create a RabbitMQ connection using pika."""
         if not self.connection or self.connection.is_closed:
-            print(f'{RABBIT_HOST=} {RABBIT_PORT=} {RABBIT_USER=} {RABBIT_PASSWORD=}')
+            logger.info(f"Connecting to RabbitMQ at {RABBIT_HOST}:{RABBIT_PORT} as {RABBIT_USER}")
             parameters = pika.ConnectionParameters(
                 host=RABBIT_HOST,
                 port=RABBIT_PORT,
@@ -40,7 +57,7 @@ class RabbitMQ:
                 body=message,
                 properties=pika.BasicProperties(delivery_mode=2)
             )
-            print(f"Sent {message} to queue {queue_name}")  # TODO: change print to save log
+            logger.debug(f"Sent {len(message)} bytes to queue {queue_name}")
         finally:
             if channel.is_open:
                 channel.close()
@@ -58,7 +75,7 @@ class RabbitMQ:
                 body=message,
                 properties=pika.BasicProperties(delivery_mode=2)
             )
-            print(f"Sent {message} to exchange {exchange_name}")  # TODO: change print to save log
+            logger.debug(f"Sent {len(message)} bytes to exchange {exchange_name}")
         finally:
             if channel.is_open:
                 channel.close()
@@ -68,9 +85,11 @@ class RabbitMQ:
         self.create_connection()  # Ensure connection is alive
         channel = self.connection.channel()
         channel.queue_declare(queue=queue_name, durable=True, arguments=self.QUEUE_DECLARE_ARGS)
-        channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
-        print(f"Starting consumer for queue {queue_name}")  # TODO: change print to save log
-        channel.start_consuming()
+        channel.basic_consume(
+            queue=queue_name, on_message_callback=functools.partial(self._call_safely, queue_name, callback), auto_ack=True
+        )
+        logger.info(f"Starting consumer for queue {queue_name}")
+        self._consume()
 
     def start_multiple_consumers(self, consumers):
         """
@@ -81,12 +100,198 @@ class RabbitMQ:
         channel = self.connection.channel()
         for queue_name, callback in consumers:
             channel.queue_declare(queue=queue_name, durable=True, arguments=self.QUEUE_DECLARE_ARGS)
-            channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
-            print(f"Starting consumer for queue {queue_name}")
-        channel.start_consuming()
+            channel.basic_consume(
+                queue=queue_name, on_message_callback=functools.partial(self._call_safely, queue_name, callback), auto_ack=True
+            )
+            logger.info(f"Starting consumer for queue {queue_name}")
+        self._consume()
+
+    def stop(self):
+        """
+        Ask the consume loop to return after the message being handled.
+        Only sets a flag, so it is safe to call from signal handlers and other threads.
+        """
+        self._stopping.set()
+
+    def _consume(self, on_tick=None):
+        """Dispatch deliveries and thread-safe callbacks until stop() is called; on_tick runs about every second."""
+        while not self._stopping.is_set():
+            self.connection.process_data_events(time_limit=1)
+            if on_tick is not None:
+                on_tick()
+
+    @staticmethod
+    def _run_callback(queue_name, callback, ch, method, properties, body):
+        """
+        Run a consumer callback, recording queue wait, processing time and outcome.
+        The broker-side queue wait depends on upstream publishers setting the AMQP timestamp;
+        messages without one are not counted.
+        """
+        if properties is not None and properties.timestamp:
+            QUEUE_WAIT.observe(max(time.time() - properties.timestamp, 0), queue=queue_name)
+        start = time.perf_counter()
+        try:
+            callback(ch, method, properties, body)
+        except Exception:
+            MESSAGES.inc(queue=queue_name, status="failed")
+            raise
+        finally:
+            MESSAGE_LATENCY.observe(time.perf_counter() - start, queue=queue_name)
+        MESSAGES.inc(queue=queue_name, status="processed")
+
+    @classmethod
+    def _call_safely(cls, queue_name, callback, ch, method, properties, body):
+        """Messages are already acked in this mode, so a failing callback must not stop consuming."""
+        try:
+            cls._run_callback(queue_name, callback, ch, method, properties, body)
+        except Exception as e:
+            logger.error(f"Unhandled error in consumer callback for queue {queue_name}: {e}")
+
+    def start_concurrent_consumers(self, consumers, prefetch_count=RABBIT_PREFETCH_COUNT, workers=RABBIT_WORKERS,
+                                   drain_timeout=RABBIT_DRAIN_TIMEOUT):
+        """
+        consumers: list of (queue_name, callback) tuples, as in start_multiple_consumers.
+        Runs up to `workers` callbacks at the same time in a thread pool, with at most
+        `prefetch_count` unacked messages delivered to this consumer. A message is acked
+        only after its callback returns. If the callback raises, the message goes to
+        <queue>.retry, which hands it back to the queue after RABBIT_RETRY_DELAY seconds, so an
+        LLM or database outage doesn't burn through the backlog; after RABBIT_MAX_RETRIES
+        retries it is parked in <queue>.dead. Messages that can't be decoded are dropped.
+        The prefetch is lowered while the background LLM budget is exhausted (see PrefetchThrottle).
+        After stop(), messages being processed get up to `drain_timeout` seconds to finish
+        and be acked; messages that haven't started are requeued for other consumers.
+        """
+        self.create_connection()
+        channel = self.connection.channel()
+        channel.basic_qos(prefetch_count=prefetch_count)
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rabbit-worker")
+        in_flight = {}  # future -> delivery tag
+        consumer_tags = []
+        for queue_name, callback in consumers:
+            channel.queue_declare(queue=queue_name, durable=True, arguments=self.QUEUE_DECLARE_ARGS)
+            self._declare_retry_queues(channel, queue_name)
+            consumer_tags.append(channel.basic_consume(
+                queue=queue_name,
+                on_message_callback=functools.partial(self._submit, executor, in_flight, queue_name, callback),
+                auto_ack=False,
+            ))
+            logger.info(f"Starting concurrent consumer for queue {queue_name} ({workers=}, {prefetch_count=})")
+        try:
+            self._consume(PrefetchThrottle(channel, prefetch_count * len(consumer_tags)).update)
+            self._drain(channel, consumer_tags, in_flight, drain_timeout)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _declare_retry_queues(channel, queue_name):
+        """<queue>.retry dead-letters messages back to the queue when they expire; <queue>.dead keeps them."""
+        channel.queue_declare(queue=f"{queue_name}.retry", durable=True, arguments={
+            'x-message-ttl': int(RABBIT_RETRY_DELAY * 1000),
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': queue_name,
+        })
+        channel.queue_declare(queue=f"{queue_name}.dead", durable=True)
+
+    def _submit(self, executor, in_flight, queue_name, callback, ch, method, properties, body):
+        future = executor.submit(self._process, queue_name, callback, ch, method, properties, body, time.perf_counter())
+        in_flight[future] = method.delivery_tag
+        future.add_done_callback(lambda done: in_flight.pop(done, None))
+
+    def _drain(self, ch, consumer_tags, in_flight, timeout):
+        """
+        Stop deliveries, requeue the messages waiting for a worker thread and keep settling
+        the running ones until they finish or `timeout` passes.
+        """
+        for consumer_tag in consumer_tags:
+            ch.basic_cancel(consumer_tag)  # pika nacks prefetched messages not yet dispatched
+        for future, delivery_tag in list(in_flight.items()):
+            if future.cancel():
+                in_flight.pop(future, None)
+                ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        logger.info(f"Draining {len(in_flight)} messages being processed")
+        deadline = time.monotonic() + timeout
+        while in_flight and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.1)
+        self.connection.process_data_events(time_limit=0)  # acks of the last messages
+        if in_flight:
+            logger.warning(f"{len(in_flight)} messages still running after {timeout}s; the broker will redeliver them")
+
+    def _process(self, queue_name, callback, ch, method, properties, body, delivered):
+        """Runs in a worker thread; acks/nacks are handed back to the connection thread."""
+        WORKER_WAIT.observe(time.perf_counter() - delivered, queue=queue_name)
+        try:
+            self._run_callback(queue_name, callback, ch, method, properties, body)
+            settle = functools.partial(self._settle, ch, method.delivery_tag, True, False)
+        except self.POISON_ERRORS as e:
+            logger.error(f"Dropping undecodable message from queue {queue_name}: {e}")
+            settle = functools.partial(self._settle, ch, method.delivery_tag, False, False)
+        except Exception as e:
+            logger.error(f"Error processing message from queue {queue_name}: {e}")
+            settle = functools.partial(self._retry, ch, queue_name, method.delivery_tag, properties, body)
+        try:
+            self.connection.add_callback_threadsafe(settle)
+        except Exception as e:
+            # The connection is gone; the broker redelivers the unacked message.
+            logger.error(f"Could not settle message {method.delivery_tag}: {e}")
+
+    @staticmethod
+    def _settle(ch, delivery_tag, ok, requeue):
+        if not ch.is_open:
+            return
+        if ok:
+            ch.basic_ack(delivery_tag=delivery_tag)
+        else:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+
+    @staticmethod
+    def _retry(ch, queue_name, delivery_tag, properties, body):
+        """Republish a failed message to <queue>.retry, or to <queue>.dead once it ran out of retries."""
+        if not ch.is_open:
+            return  # the broker redelivers the unacked message
+        properties = copy.copy(properties) if properties is not None else pika.BasicProperties()
+        properties.headers = dict(properties.headers or {})
+        retries = properties.headers["x-retries"] = properties.headers.get("x-retries", 0) + 1
+        properties.delivery_mode = 2
+        if retries > RABBIT_MAX_RETRIES:
+            logger.error(f"Message failed {RABBIT_MAX_RETRIES} retries, parking it in {queue_name}.dead")
+            routing_key = f"{queue_name}.dead"
+        else:
+            routing_key = f"{queue_name}.retry"
+        ch.basic_publish(exchange='', routing_key=routing_key, body=body, properties=properties)
+        ch.basic_ack(delivery_tag=delivery_tag)
 
     def close_connection(self):
         """Safely close the RabbitMQ connection."""
         if self.connection and not self.connection.is_closed:
             self.connection.close()
-            print("Connection closed")  # TODO: change print to save log
+            logger.info("Connection closed")
+
+
+class PrefetchThrottle:
+    """
+    Matches the prefetch to the LLM admission budget. While background LLM requests of this
+    process wait for a slot, more messages would only wait too, so the prefetch is halved, down
+    to one message per background slot, and the broker keeps the rest for other workers.
+    While a background slot is free it grows by one message per update, up to `maximum`.
+    RabbitMQ applies a per-consumer prefetch only to consumers started after it is set, so the
+    throttle changes the channel-wide limit (global_qos), which applies at once on top of it.
+    """
+
+    def __init__(self, channel, maximum):
+        self.channel = channel
+        self.maximum = maximum
+        self.prefetch_count = maximum
+
+    def update(self):
+        active, waiting = admission.usage("background")
+        limit = admission.lane_limit("background")
+        if waiting:
+            wanted = max(1, min(limit, self.maximum), self.prefetch_count // 2)
+        elif active < limit:
+            wanted = min(self.maximum, self.prefetch_count + 1)
+        else:
+            return
+        if wanted != self.prefetch_count:
+            logger.debug(f"Changing the channel prefetch_count from {self.prefetch_count} to {wanted}")
+            self.channel.basic_qos(prefetch_count=wanted, global_qos=True)
+            self.prefetch_count = wanted
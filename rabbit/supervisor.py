@@ -0,0 +1,243 @@
+"""
+Runs the queue consumers as a pool of worker processes per queue, inside one container:
+
+    python -m rabbit.supervisor
+
+Each worker process has its own RabbitMQ connection and runs rabbit.consumer for one queue.
+Every SUPERVISOR_SCALE_INTERVAL seconds the supervisor reads the queue depths with a passive
+queue_declare and sizes each pool to one process per SUPERVISOR_MESSAGES_PER_WORKER ready
+messages, within the pool's min and max. Pools grow right away and shrink by one process
+after the depth has stayed low for SUPERVISOR_SCALE_DOWN_DELAY seconds. Workers that exit are
+replaced. On SIGTERM or SIGINT the workers drain their in-flight messages before it exits.
+The supervisor serves its own metrics on WORKER_METRICS_PORT and every worker serves its metrics
+on one of the ports after it, the lowest one free when it starts.
+Workers size their database pools with WORKER_DB_POOL_SIZE and WORKER_DB_MAX_OVERFLOW instead of
+DB_POOL_SIZE and DB_MAX_OVERFLOW, so that a full set of workers stays within Postgres' max_connections.
+"""
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import pika
+
+from config import (
+    SUPERVISOR_QUEUE_WORKERS, SUPERVISOR_MIN_WORKERS, SUPERVISOR_MAX_WORKERS, SUPERVISOR_MESSAGES_PER_WORKER,
+    SUPERVISOR_SCALE_INTERVAL, SUPERVISOR_SCALE_DOWN_DELAY, RABBIT_DRAIN_TIMEOUT, WORKER_METRICS_PORT,
+    WORKER_DB_POOL_SIZE, WORKER_DB_MAX_OVERFLOW,
+)
+import metrics
+from metrics import SUPERVISOR_WORKERS, SUPERVISOR_QUEUE_DEPTH
+from rabbit.consumer import CONSUMERS, backoff_delays, start_consumer
+from rabbit.rabbitmq import RabbitMQ
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(queue_name, metrics_port):
+    """Entry point of a worker process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor turns Ctrl+C into SIGTERM
+    start_consumer([queue_name], metrics_port=metrics_port)
+
+
+class MetricsPorts:
+    """Metrics ports of the worker processes: base + 1, base + 2, ..., reused once a worker has exited."""
+
+    def __init__(self, base=WORKER_METRICS_PORT):
+        self.base = base
+        self._owners = {}  # port -> process, None while the process is being started
+
+    def take(self) -> int:
+        """Reserve a free port, or return 0 (no metrics server) when the base port is 0."""
+        if not self.base:
+            return 0
+        port = next(port for port in itertools.count(self.base + 1) if port not in self._owners)
+        self._owners[port] = None
+        return port
+
+    def assign(self, port, process):
+        if port:
+            self._owners[port] = process
+
+    def release(self, process):
+        self._owners = {port: owner for port, owner in self._owners.items() if owner is not process}
+
+
+class WorkerPool:
+    """Worker processes consuming one queue."""
+
+    def __init__(self, queue_name, min_workers, max_workers, context, ports):
+        self.queue_name = queue_name
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.context = context
+        self.ports = ports
+        self.workers = []  # oldest first
+        self.draining = []
+        self._low_since = None
+
+    def target(self, depth) -> int:
+        """Workers wanted for `depth` ready messages; without a depth the pool keeps its size."""
+        wanted = len(self.workers) if depth is None else math.ceil(depth / SUPERVISOR_MESSAGES_PER_WORKER)
+        return min(self.max_workers, max(self.min_workers, wanted))
+
+    def scale(self, depth):
+        self._reap()
+        target = self.target(depth)
+        if target >= len(self.workers):
+            self._low_since = None
+            for _ in range(target - len(self.workers)):
+                self._start_worker()
+        elif self._low_since is None:
+            self._low_since = time.monotonic()
+        elif time.monotonic() - self._low_since >= SUPERVISOR_SCALE_DOWN_DELAY:
+            self._stop_worker()
+            self._low_since = time.monotonic()  # shrink one process per delay
+        SUPERVISOR_WORKERS.set(len(self.workers), queue=self.queue_name)
+
+    def stop(self):
+        """Ask every worker to drain and exit."""
+        while self.workers:
+            self._stop_worker()
+
+    def join(self, deadline):
+        """Wait for stopped workers until `deadline` (time.monotonic()), then kill the rest."""
+        for process in self.draining:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Worker {process.pid} for {self.queue_name} did not stop in time, killing it")
+                process.kill()
+                process.join()
+            self.ports.release(process)
+        self.draining = []
+
+    def _start_worker(self):
+        port = self.ports.take()
+        process = self.context.Process(target=run_worker, args=(self.queue_name, port), name=f"worker-{self.queue_name}")
+        process.start()
+        self.ports.assign(port, process)
+        self.workers.append(process)
+        logger.info(f"Started worker {process.pid} for {self.queue_name} on metrics port {port} "
+                    f"({len(self.workers)} running)")
+
+    def _stop_worker(self):
+        process = self.workers.pop()
+        process.terminate()  # SIGTERM: the worker finishes its messages and exits
+        self.draining.append(process)
+        logger.info(f"Stopping worker {process.pid} for {self.queue_name} ({len(self.workers)} running)")
+
+    def _reap(self):
+        for process in self.workers:
+            if not process.is_alive():
+                logger.warning(f"Worker {process.pid} for {self.queue_name} exited with code {process.exitcode}")
+        for process in self.workers + self.draining:
+            if not process.is_alive():
+                self.ports.release(process)
+        self.workers = [process for process in self.workers if process.is_alive()]
+        self.draining = [process for process in self.draining if process.is_alive()]
+
+
+class QueueMonitor:
+    """Reads queue depths over its own connection, reconnecting with backoff when it breaks."""
+
+    def __init__(self):
+        self._rabbit = None
+        self._channel = None
+        self._delays = backoff_delays()
+        self._retry_at = 0.0
+
+    def depths(self, queue_names) -> dict:
+        """Ready messages per queue; None for all of them while the broker can't be reached."""
+        if time.monotonic() < self._retry_at:
+            return dict.fromkeys(queue_names)
+        try:
+            depths = {queue_name: self._depth(queue_name) for queue_name in queue_names}
+        except pika.exceptions.AMQPError as e:
+            delay = next(self._delays)
+            logger.error(f"Could not read queue depths ({e!r}), retrying in {delay:.1f}s")
+            self._retry_at = time.monotonic() + delay
+            self.close()
+            return dict.fromkeys(queue_names)
+        self._delays = backoff_delays()
+        return depths
+
+    def _depth(self, queue_name) -> int:
+        if self._rabbit is None:
+            self._rabbit = RabbitMQ()
+        if self._channel is None or self._channel.is_closed:
+            self._channel = self._rabbit.connection.channel()
+        try:
+            return self._channel.queue_declare(queue=queue_name, passive=True).method.message_count
+        except pika.exceptions.ChannelClosedByBroker:
+            return 0  # not declared yet; the broker closed the channel with 404
+
+    def close(self):
+        if self._rabbit is not None:
+            try:
+                self._rabbit.close_connection()
+            except pika.exceptions.AMQPError:
+                pass
+        self._rabbit = self._channel = None
+
+
+class Supervisor:
+    def __init__(self, pools):
+        self.pools = pools
+        self.monitor = QueueMonitor()
+        self._stopping = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        self._stopping.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if WORKER_METRICS_PORT:
+            metrics.start_http_server(WORKER_METRICS_PORT)
+        try:
+            while not self._stopping.is_set():
+                depths = self.monitor.depths([pool.queue_name for pool in self.pools])
+                for pool in self.pools:
+                    depth = depths[pool.queue_name]
+                    if depth is not None:
+                        SUPERVISOR_QUEUE_DEPTH.set(depth, queue=pool.queue_name)
+                    pool.scale(depth)
+                self._stopping.wait(SUPERVISOR_SCALE_INTERVAL)
+        finally:
+            logger.info("Stopping workers")
+            for pool in self.pools:
+                pool.stop()
+            deadline = time.monotonic() + RABBIT_DRAIN_TIMEOUT + 5
+            for pool in self.pools:
+                pool.join(deadline)
+            self.monitor.close()
+            logger.info("Supervisor stopped")
+
+
+def load_pools(context) -> list:
+    """A pool per consumed queue, with the limits from SUPERVISOR_QUEUE_WORKERS or the defaults."""
+    limits = json.loads(SUPERVISOR_QUEUE_WORKERS) if SUPERVISOR_QUEUE_WORKERS else {}
+    ports = MetricsPorts()
+    pools = []
+    for queue_name in CONSUMERS:
+        queue_limits = limits.get(queue_name, {})
+        pools.append(WorkerPool(
+            queue_name,
+            queue_limits.get("min", SUPERVISOR_MIN_WORKERS),
+            queue_limits.get("max", SUPERVISOR_MAX_WORKERS),
+            context,
+            ports,
+        ))
+    return pools
+
+
+if __name__ == '__main__':
+    # Workers are spawned rather than forked, so they don't inherit the supervisor's connections and threads.
+    # They read the settings anew from the environment they inherit, which gets the worker pool sizes.
+    os.environ.update(DB_POOL_SIZE=str(WORKER_DB_POOL_SIZE), DB_MAX_OVERFLOW=str(WORKER_DB_MAX_OVERFLOW))
+    Supervisor(load_pools(multiprocessing.get_context("spawn"))).run()
@@ -0,0 +1,99 @@
+"""
+Keeps query_result_rollup up to date off the write path:
+
+    python -m rollup            # refresh once
+    python -m rollup --rebuild  # recount every hour from query_results
+
+Every upsert of a query result stamps updated_at. A refresh recounts the (service, hour) buckets
+of the rows updated since the last refresh and replaces their rollup rows, so writers never
+touch the rollup table. The API refreshes every ROLLUP_REFRESH_INTERVAL seconds; an advisory lock
+makes sure only one process refreshes at a time. The first refresh recounts everything, and so
+does --rebuild, which is also the way to account for deleted rows.
+"""
+import argparse
+import asyncio
+import logging
+from datetime import timedelta
+
+from sqlalchemy import text
+
+from config import ROLLUP_REFRESH_INTERVAL, ROLLUP_REFRESH_OVERLAP
+
+logger = logging.getLogger(__name__)
+
+_COUNT = """
+    INSERT INTO query_result_rollup (service, bucket, sentiment_value, category_mask, count)
+    SELECT service, date_trunc('hour', ts), sentiment_value, category_mask, count(*)
+    FROM query_results
+    GROUP BY 1, 2, 3, 4
+"""
+
+# Joins on a ts range rather than on date_trunc('hour', ts), so ix_query_results_service_ts
+# serves each touched bucket instead of a scan of every row of its service.
+_RECOUNT = """
+    INSERT INTO query_result_rollup (service, bucket, sentiment_value, category_mask, count)
+    SELECT q.service, t.bucket, q.sentiment_value, q.category_mask, count(*)
+    FROM touched_buckets t
+    JOIN query_results q
+      ON q.service = t.service AND q.ts >= t.bucket AND q.ts < t.bucket + interval '1 hour'
+    GROUP BY 1, 2, 3, 4
+"""
+
+# Buckets with a row updated since the previous refresh started, less ROLLUP_REFRESH_OVERLAP
+# seconds for transactions that stamped their rows earlier but committed after it.
+_TOUCHED = """
+    CREATE TEMPORARY TABLE touched_buckets ON COMMIT DROP AS
+    SELECT DISTINCT service, date_trunc('hour', ts) AS bucket
+    FROM query_results
+    WHERE updated_at >= :since
+"""
+
+
+def refresh_rollup(engine, rebuild=False) -> bool:
+    """
+    Bring the rollup up to date in one transaction. Returns False without doing anything when
+    another process is refreshing.
+    """
+    with engine.begin() as connection:
+        if not connection.execute(text("SELECT pg_try_advisory_xact_lock(hashtext('refresh_rollup'))")).scalar():
+            return False
+        started = connection.execute(text("SELECT timezone('utc', now())")).scalar()
+        watermark = connection.execute(text("SELECT watermark FROM query_result_rollup_state WHERE id = 1")).scalar()
+        if rebuild or watermark is None:
+            connection.execute(text("DELETE FROM query_result_rollup"))
+            connection.execute(text(_COUNT))
+        else:
+            connection.execute(text(_TOUCHED), {"since": watermark - timedelta(seconds=ROLLUP_REFRESH_OVERLAP)})
+            connection.execute(text(
+                "DELETE FROM query_result_rollup r USING touched_buckets t "
+                "WHERE r.service = t.service AND r.bucket = t.bucket"
+            ))
+            connection.execute(text(_RECOUNT))
+        connection.execute(text(
+            "INSERT INTO query_result_rollup_state (id, watermark) VALUES (1, :started) "
+            "ON CONFLICT (id) DO UPDATE SET watermark = excluded.watermark"
+        ), {"started": started})
+    return True
+
+
+async def refresh_periodically(engine):
+    """Refresh the rollup every ROLLUP_REFRESH_INTERVAL seconds until cancelled."""
+    while True:
+        try:
+            await asyncio.to_thread(refresh_rollup, engine)
+        except Exception as e:
+            logger.error(f"Failed to refresh the analytics rollup: {e}")
+        await asyncio.sleep(ROLLUP_REFRESH_INTERVAL)
+
+
+if __name__ == '__main__':
+    from db import engine
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog="rollup", description="Refresh the analytics rollup table.")
+    parser.add_argument("--rebuild", action="store_true", help="recount every hour from query_results")
+    args = parser.parse_args()
+    if refresh_rollup(engine, rebuild=args.rebuild):
+        logger.info("Rollup refreshed")
+    else:
+        logger.info("Another process is refreshing the rollup")
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+
+from sqlalchemy import text
+
+from config import SINGLEFLIGHT_ENABLED, SINGLEFLIGHT_ADVISORY_LOCK
+from db import engine, async_engine
+from metrics import COALESCED
+
+_lock_sql = text("SELECT pg_advisory_lock(hashtext(:key))")
+_unlock_sql = text("SELECT pg_advisory_unlock(hashtext(:key))")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent async calls with the same key: the first caller runs the call,
+    later callers wait for its result instead of running their own.
+    Calls are tracked per event loop, as their futures can't be awaited from another loop.
+    """
+
+    def __init__(self, name: str, enabled=SINGLEFLIGHT_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self._calls = {}
+
+    async def do(self, key, call):
+        """Returns the result of call(), or of the identical call already in flight."""
+        if not self.enabled:
+            return await call()
+
+        loop = asyncio.get_running_loop()
+        task = self._calls.get((loop, key))
+        if task is not None:
+            COALESCED.inc(scope=self.name)
+        else:
+            task = self._calls[(loop, key)] = loop.create_task(call())
+            task.add_done_callback(lambda _: self._calls.pop((loop, key), None))
+        # A cancelled waiter must not cancel the call the other waiters share.
+        return await asyncio.shield(task)
+
+
+class ThreadSingleFlight:
+    """Same as SingleFlight, for blocking calls made from several threads."""
+
+    def __init__(self, name: str, enabled=SINGLEFLIGHT_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, call):
+        if not self.enabled:
+            return call()
+
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            COALESCED.inc(scope=self.name)
+            return future.result()
+
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+@contextmanager
+def _advisory_lock(key: str):
+    with engine.connect() as connection:
+        connection.execute(_lock_sql, {"key": key})
+        try:
+            yield
+        finally:
+            connection.execute(_unlock_sql, {"key": key})
+
+
+@asynccontextmanager
+async def _async_advisory_lock(key: str):
+    async with async_engine.connect() as connection:
+        await connection.execute(_lock_sql, {"key": key})
+        try:
+            yield
+        finally:
+            await connection.execute(_unlock_sql, {"key": key})
+
+
+def process_lock(key: str):
+    """
+    Serializes work on the key across processes with a Postgres session advisory lock
+    when SINGLEFLIGHT_ADVISORY_LOCK is set, otherwise does nothing.
+    The lock holds a pooled connection until it is released.
+    """
+    return _advisory_lock(key) if SINGLEFLIGHT_ADVISORY_LOCK else nullcontext()
+
+
+def async_process_lock(key: str):
+    """Async variant of process_lock, using the async engine."""
+    return _async_advisory_lock(key) if SINGLEFLIGHT_ADVISORY_LOCK else nullcontext()
@@ -0,0 +1,67 @@
+import asyncio
+import hashlib
+import json
+import re
+
+from llm_client import Backend, DEFAULT_PROFILE
+from parsing import CATEGORIES
+
+_numbered_text = re.compile(r"^(\d+)\) ", re.MULTILINE)
+
+
+def _pick(seed: str):
+    """Deterministic (sentiment, category) for a piece of text."""
+    digest = int(hashlib.sha256(seed.encode("utf-8")).hexdigest(), 16)
+    return digest % 3 - 1, CATEGORIES[digest // 3 % len(CATEGORIES)]
+
+
+def answer(prompt: str) -> str:
+    """
+    A well-formed answer to any of the analysis prompts, derived from a hash of the prompt,
+    so the same text always gets the same result without a real model.
+    """
+    sentiment, category = _pick(prompt)
+    if '"results"' in prompt:
+        texts = prompt[prompt.rindex("Texts:"):]
+        results = []
+        for number in _numbered_text.findall(texts):
+            sentiment, category = _pick(f"{prompt}\x00{number}")
+            results.append({"id": int(number), "sentiment": sentiment, "categories": [category]})
+        return json.dumps({"results": results})
+    if '"sentiment"' in prompt:
+        return json.dumps({"sentiment": sentiment, "categories": [category]})
+    if "JSON array" in prompt:
+        return json.dumps([category])
+    return str(sentiment)
+
+
+class StubBackend(Backend):
+    """
+    In-process stand-in for an LLM server, for tests, benchmarks and dry runs.
+    Serves every model and answers after `latency` seconds, streaming `token_rate` tokens per second.
+    """
+    type = "stub"
+
+    def __init__(self, name="stub", latency=0.0, token_rate=0.0, max_concurrency=64):
+        super().__init__(name, [], max_concurrency)
+        self.latency = latency
+        self.token_rate = token_rate
+
+    def serves(self, model: str) -> bool:
+        return True
+
+    def model_for(self, model: str) -> str:
+        return model
+
+    async def generate(self, prompt: str, model: str, profile=DEFAULT_PROFILE) -> str:
+        async with self._semaphore:
+            await asyncio.sleep(self.latency)
+            return answer(prompt)
+
+    async def stream(self, prompt: str, model: str, profile=DEFAULT_PROFILE):
+        async with self._semaphore:
+            await asyncio.sleep(self.latency)
+            for token in re.findall(r"\s*\S{1,4}", answer(prompt)):
+                if self.token_rate:
+                    await asyncio.sleep(1 / self.token_rate)
+                yield token